@@ -1,9 +1,14 @@
+import threading
+import weakref
+from collections import defaultdict
 from decimal import Decimal
+from fractions import Fraction
 
-from sqlalchemy import Column, VARCHAR, INTEGER, cast, Float
+from sqlalchemy import Column, VARCHAR, INTEGER, cast, Float, select, func, inspect, event
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm.interfaces import MANYTOONE
 
-from .sa_extra import DeclarativeBase, _Date, long
+from .sa_extra import DeclarativeBase, _Date, _DateTime, long
 
 
 class GnucashException(Exception):
@@ -56,6 +61,40 @@ class Recurrence(DeclarativeBase):
 MAX_NUMBER = 2 ** 63 - 1
 
 
+def to_decimal(d):
+    """Convert a value given for a gnc numeric (Decimal, int, str or (num, denom) tuple) to a Decimal
+
+    :raise TypeError: if the value is a float or of an unknown type
+    """
+    if isinstance(d, tuple):
+        d = Decimal(d[0]) / d[1]
+    elif isinstance(d, (int, long, str)):
+        d = Decimal(d)
+    elif isinstance(d, float):
+        raise TypeError(("Received a floating-point number {} where a decimal is expected. " +
+                         "Use a Decimal, str, or int instead").format(d))
+    elif not isinstance(d, Decimal):
+        raise TypeError(("Received an unknown type {} where a decimal is expected. " +
+                         "Use a Decimal, str, or int instead").format(type(d).__name__))
+    return d
+
+
+def decimal_to_gncnumeric(d, denom=None):
+    """Return the (num, denom) representation of a Decimal (with the given denominator if specified)
+
+    :raise ValueError: if the Decimal cannot be represented in GnuCash
+    """
+    if denom is None:
+        sign, digits, exp = d.as_tuple()
+        denom = 10 ** max(-exp, 0)
+
+    num = int(d * denom)
+    if not ((-MAX_NUMBER < num < MAX_NUMBER) and (-MAX_NUMBER < denom < MAX_NUMBER)):
+        raise ValueError(("The amount '{}' cannot be represented in GnuCash. " +
+                          "Either it is too large or it has too many decimals").format(d))
+    return num, denom
+
+
 def hybrid_property_gncnumeric(num_col, denom_col):
     """Return an hybrid_property handling a Decimal represented by a numerator and a
     denominator column.
@@ -72,28 +111,8 @@ def hybrid_property_gncnumeric(num_col, denom_col):
         if d is None:
             num, denom = None, None
         else:
-            if isinstance(d, tuple):
-                d = Decimal(d[0]) / d[1]
-            elif isinstance(d, (int, long, str)):
-                d = Decimal(d)
-            elif isinstance(d, float):
-                raise TypeError(("Received a floating-point number {} where a decimal is expected. " +
-                                 "Use a Decimal, str, or int instead").format(d))
-            elif not isinstance(d, Decimal):
-                raise TypeError(("Received an unknown type {} where a decimal is expected. " +
-                                 "Use a Decimal, str, or int instead").format(type(d).__name__))
-
-            sign, digits, exp = d.as_tuple()
-            denom = 10 ** max(-exp, 0)
-
-            denom_basis = getattr(self, "{}_basis".format(denom_name), None)
-            if denom_basis is not None:
-                denom = denom_basis
-
-            num = int(d * denom)
-            if not ((-MAX_NUMBER < num < MAX_NUMBER) and (-MAX_NUMBER < denom < MAX_NUMBER)):
-                raise ValueError(("The amount '{}' cannot be represented in GnuCash. " +
-                                  "Either it is too large or it has too many decimals").format(d))
+            d = to_decimal(d)
+            num, denom = decimal_to_gncnumeric(d, getattr(self, "{}_basis".format(denom_name), None))
 
         setattr(self, num_name, num)
         setattr(self, denom_name, denom)
@@ -106,7 +125,7 @@ def hybrid_property_gncnumeric(num_col, denom_col):
             return Decimal(num) / denom
 
     def expr(cls):
-        # todo: cast into Decimal for postgres and for sqlite (for the latter, use sqlite3.register_converter ?)
+        # this expression is approximate (float), use sum_gncnumeric for exact aggregations in SQL
         return (cast(num_col, Float) / denom_col).label(name)
 
     return hybrid_property(
@@ -116,18 +135,197 @@ def hybrid_property_gncnumeric(num_col, denom_col):
     )
 
 
+def gncnumeric_sums(session, num_col, denom_col, group_by=(), where=(), from_obj=None):
+    """Return a dict with the exact sum (as a :class:`fractions.Fraction`) of a gnc numeric represented by a numerator
+    and a denominator column, for each combination of values of the group_by columns (the keys of the dict are tuples).
+
+    The numerators are summed in SQL (as integers) grouped by denominator and the partial sums are combined exactly
+    in python. Unlike an aggregate on the hybrid expression (that casts the numerator to a float), no precision is
+    lost and the same query works on sqlite, postgres and mysql.
+
+    :param session: the sqlalchemy session (or connection) used to execute the query
+    :type num_col: sqlalchemy.sql.schema.Column
+    :type denom_col: sqlalchemy.sql.schema.Column
+    :param group_by: the columns to group by
+    :param where: the clauses to filter the rows on
+    :param from_obj: the table or join to select from (if it cannot be derived from the columns)
+    :return: dict of :class:`fractions.Fraction`
+    """
+    group_by = list(group_by)
+    query = select(group_by + [denom_col, func.sum(num_col)]).group_by(*(group_by + [denom_col]))
+    if from_obj is not None:
+        query = query.select_from(from_obj)
+    for clause in where:
+        query = query.where(clause)
+
+    n = len(group_by)
+    sums = defaultdict(Fraction)
+    for row in session.execute(query):
+        sums[tuple(row[:n])] += Fraction(int(row[n + 1]), row[n])
+
+    return sums
+
+
+def fraction_to_decimal(f):
+    """Convert a :class:`fractions.Fraction` to a :class:`decimal.Decimal` (as done when reading a gnc numeric)"""
+    return Decimal(f.numerator) / f.denominator
+
+
+def sum_gncnumeric(session, num_col, denom_col, group_by=(), where=(), from_obj=None):
+    """Return the exact sum of a gnc numeric computed in SQL (see :func:`gncnumeric_sums` for the arguments).
+
+    To be used as::
+
+        # total of the values of all splits
+        sum_gncnumeric(book.session, Split._value_num, Split._value_denom)
+
+        # balance of each account (keys are tuples with the account guid)
+        sum_gncnumeric(book.session, Split._quantity_num, Split._quantity_denom, group_by=[Split.account_guid])
+
+    :return: a :class:`decimal.Decimal` if group_by is empty, otherwise a dict of :class:`decimal.Decimal`
+    """
+    sums = gncnumeric_sums(session, num_col, denom_col, group_by, where, from_obj)
+    if group_by:
+        return {k: fraction_to_decimal(v) for k, v in sums.items()}
+    else:
+        return fraction_to_decimal(sums.get((), Fraction(0)))
+
+
+# for the id of each object indexed by CallableLists, the weak references to these lists (keyed by id of the list)
+_indexing_lists = {}
+# guards _indexing_lists that is changed by the sessions of all threads and by the garbage collector (reentrant
+# as the callbacks of the weak references can run in the thread holding it)
+_indexing_lists_lock = threading.RLock()
+# the (class, attribute) that can be indexed, i.e. whose changes drop the indexes (set when the mappers are configured)
+_watched_attributes = set()
+
+
+def _forget_indexed_ids(list_id, indexed_ids):
+    """Remove the CallableList list_id from the reverse map of the objects it indexes"""
+    with _indexing_lists_lock:
+        for obj_id in indexed_ids:
+            lists = _indexing_lists.get(obj_id)
+            if lists is not None:
+                lists.pop(list_id, None)
+                if not lists:
+                    del _indexing_lists[obj_id]
+
+
+def _drop_indexes_containing(target, keys=None):
+    """Drop the indexes of the CallableLists containing target that are indexed on one of the attributes keys
+    (or on any attribute if keys is None)"""
+    if id(target) not in _indexing_lists:
+        return
+    with _indexing_lists_lock:
+        refs = list(_indexing_lists.get(id(target), {}).values())
+    for ref in refs:
+        l = ref()
+        if l is not None and l._indexes and (keys is None or
+                                             any(k in keys for index_keys in l._indexes for k in index_keys)):
+            l._drop_indexes()
+
+
+def _attribute_set_listener(key):
+    def attribute_set(target, value, oldvalue, initiator):
+        _drop_indexes_containing(target, [key])
+
+    return attribute_set
+
+
+def _instance_expired(target, attrs):
+    _drop_indexes_containing(target, attrs)
+
+
+def _instance_refreshed(target, context, attrs):
+    _drop_indexes_containing(target, attrs)
+
+
+@event.listens_for(DeclarativeBase, "mapper_configured", propagate=True)
+def _watch_attributes(mapper, cls):
+    """Drop the indexes on an attribute of the CallableLists containing an object when the attribute is set,
+    expired or refreshed on the object"""
+    # reloaded values (after an expire or a rollback) do not trigger set events
+    event.listen(cls, "expire", _instance_expired)
+    event.listen(cls, "refresh", _instance_refreshed)
+    for attr in mapper.attrs:
+        event.listen(getattr(cls, attr.key), "set", _attribute_set_listener(attr.key))
+        _watched_attributes.add((cls, attr.key))
+
+
+def _matches(obj, kwargs):
+    """Return True if the attributes of obj have the values given in kwargs"""
+    for k, v in kwargs.items():
+        if getattr(obj, k) != v:
+            return False
+    return True
+
+
 class CallableList(list):
     """
     A simple class (inherited from list) allowing to retrieve a given list element with a filter on an attribute.
 
     It can be used as the collection_class of a sqlalchemy relationship or to wrap any list (see examples
     in :class:`piecash.core.session.GncSession`)
+
+    The `finders` dict can map an attribute name to a function returning the element with a given value for the
+    attribute (or None if it cannot find it). It is used instead of scanning the list when filtering on this
+    single attribute.
+
+    Filters on mapped attributes are done through hash indexes (one per tuple of attributes) built on demand
+    (for lists of at least `index_min_size` elements, smaller lists are scanned).
+    The indexes are dropped when the list is changed (through its methods or through the sqlalchemy relationship
+    events that call them) or when one of their attributes is set, expired or refreshed on an object of the list.
     """
     fallback = None
+    finders = None
+    index_min_size = 8
+    _indexes = None
+    _indexed_ids = None
 
     def __init__(self, *args):
         list.__init__(self, *args)
 
+    def _drop_indexes(self):
+        """Drop the indexes of the list"""
+        if self._indexed_ids:
+            _forget_indexed_ids(id(self), self._indexed_ids)
+        self._indexes = None
+        self._indexed_ids = None
+
+    def _index(self, keys):
+        """Return the hash index of the elements of the list on the tuple of attributes keys (or None if
+        the list cannot be indexed on the attributes or is too small to be indexed)"""
+        if self._indexes is not None and keys in self._indexes:
+            return self._indexes[keys]
+        if len(self) < self.index_min_size:
+            return None
+
+        index = {}
+        try:
+            for cls in set(type(obj) for obj in self):
+                if not all((cls, k) in _watched_attributes for k in keys):
+                    raise TypeError("{} cannot be indexed on {}".format(cls, keys))
+            for obj in self:
+                index.setdefault(tuple(getattr(obj, k) for k in keys), obj)
+        except TypeError:
+            # unhashable values or attributes that are not mapped
+            index = None
+        else:
+            if self._indexed_ids is None:
+                self._indexed_ids = set(id(obj) for obj in self)
+                # the list is removed from the reverse map when its indexes are dropped or when it is
+                # garbage collected
+                ref = weakref.ref(self, lambda _, list_id=id(self), ids=self._indexed_ids:
+                                  _forget_indexed_ids(list_id, ids))
+                with _indexing_lists_lock:
+                    for obj_id in self._indexed_ids:
+                        _indexing_lists.setdefault(obj_id, {})[id(self)] = ref
+        # the indexes may have been dropped by the refresh of expired objects while building the index
+        if self._indexes is None:
+            self._indexes = {}
+        self._indexes[keys] = index
+        return index
+
     def __call__(self, **kwargs):
         """
         Return the first element of the list that has attributes matching the kwargs dict. The `get` method is
@@ -137,20 +335,131 @@ class CallableList(list):
 
             l(mnemonic="EUR", namespace="CURRENCY")
         """
-        for obj in self:
-            for k, v in kwargs.items():
-                if getattr(obj, k) != v:
-                    break
-            else:
-                return obj
+        if self.finders and len(kwargs) == 1:
+            (k, v), = kwargs.items()
+            if k in self.finders:
+                obj = self.finders[k](v)
+                if obj is not None:
+                    return obj
+
+        keys = tuple(sorted(kwargs))
+        index = self._index(keys) if keys else None
+        if index is not None:
+            try:
+                return index[tuple(kwargs[k] for k in keys)]
+            except KeyError:
+                pass
+            except TypeError:
+                # unhashable value
+                index = None
+
+        if index is None:
+            for obj in self:
+                if _matches(obj, kwargs):
+                    return obj
+
+        if self.fallback:
+            return self.fallback(**kwargs)
         else:
-            if self.fallback:
-                return self.fallback(**kwargs)
-            else:
-                raise KeyError("Could not find object with {} in {}".format(kwargs, self))
+            raise KeyError("Could not find object with {} in {}".format(kwargs, self))
 
     get = __call__
 
 
+def _invalidating_list_method(name):
+    """Return a method dropping the indexes of the CallableList before calling the list method"""
+    method = getattr(list, name)
+
+    def invalidating_method(self, *args, **kwargs):
+        self._drop_indexes()
+        return method(self, *args, **kwargs)
+
+    invalidating_method.__name__ = name
+    return invalidating_method
+
+
+for _name in ["__setitem__", "__delitem__", "__iadd__", "__imul__", "__setslice__", "__delslice__",
+              "append", "extend", "insert", "pop", "remove", "reverse", "sort", "clear"]:
+    if hasattr(list, _name):
+        setattr(CallableList, _name, _invalidating_list_method(_name))
+
+
+class QueryCallableList(CallableList):
+    """
+    A :class:`CallableList` backed by a sqlalchemy query that is only run when the list is used as a list
+    (iteration, len, indexing, ...).
+
+    Calling the list with filters on mapped columns (or many-to-one relationships) of the entity of the query
+    retrieves the first matching object with a filter_by(...).first() on the query instead of loading all
+    the objects. The filters are checked again in python on the object retrieved as the comparison of strings
+    depends on the database (e.g. mysql ignores the case and the trailing spaces by default) and the list
+    is loaded and scanned in python if the database finds no object.
+    Other filters (e.g. fullname on accounts or the dates, which sqlite stores in several formats) are evaluated
+    in python on the loaded list.
+    """
+
+    def __init__(self, query):
+        CallableList.__init__(self)
+        self._query = query
+        self._loaded = False
+
+    def _load(self):
+        if not self._loaded:
+            self._loaded = True
+            list.extend(self, self._query)
+
+    def _is_sql_filter(self, kwargs):
+        mapper = inspect(self._query.column_descriptions[0]["entity"])
+        for k in kwargs:
+            if k in mapper.column_attrs:
+                if any(isinstance(col.type, (_Date, _DateTime)) for col in mapper.column_attrs[k].columns):
+                    return False
+                continue
+            if k in mapper.relationships and mapper.relationships[k].direction is MANYTOONE:
+                continue
+            return False
+        return True
+
+    def __call__(self, **kwargs):
+        if self._loaded or not kwargs or not self._is_sql_filter(kwargs) or \
+                (self.finders and len(kwargs) == 1 and list(kwargs)[0] in self.finders):
+            return CallableList.__call__(self, **kwargs)
+
+        query = self._query.filter_by(**kwargs)
+        obj = query.first()
+        if obj is not None and not _matches(obj, kwargs):
+            # the first object only matches for the database, look for the next ones
+            obj = next((obj for obj in query if _matches(obj, kwargs)), None)
+        if obj is not None:
+            return obj
+        # the database may not find values that are equal in python (e.g. numbers stored as strings in sqlite)
+        return CallableList.__call__(self, **kwargs)
+
+    get = __call__
+
+
+def _loading_list_method(name):
+    """Return a method loading the QueryCallableList (and the QueryCallableList in its arguments) before
+    calling the method of the CallableList"""
+    method = getattr(CallableList, name)
+
+    def loading_method(self, *args, **kwargs):
+        for obj in (self,) + args:
+            if isinstance(obj, QueryCallableList):
+                obj._load()
+        return method(self, *args, **kwargs)
+
+    loading_method.__name__ = name
+    return loading_method
+
+
+for _name in ["__iter__", "__len__", "__getitem__", "__setitem__", "__delitem__", "__contains__", "__reversed__",
+              "__eq__", "__ne__", "__lt__", "__le__", "__gt__", "__ge__", "__add__", "__iadd__", "__mul__",
+              "__imul__", "__repr__", "__getslice__", "__setslice__", "__delslice__",
+              "append", "extend", "insert", "pop", "remove", "reverse", "sort", "index", "count", "copy", "clear"]:
+    if hasattr(list, _name):
+        setattr(QueryCallableList, _name, _loading_list_method(_name))
+
+
 class GncImbalanceError(GncValidationError):
     pass
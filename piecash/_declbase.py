@@ -5,7 +5,7 @@ from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.orm import relation, foreign, object_session
 
 from ._common import CallableList
-from .kvp import DictWrapper, Slot
+from .kvp import DictWrapper, Slot, index_slot_appended, index_slot_removed
 from .sa_extra import DeclarativeBase
 
 
@@ -41,3 +41,10 @@ class DeclarativeBaseGuid(DictWrapper, DeclarativeBase):
                     s.expunge(value)
                 else:
                     s.delete(value)
+
+
+@event.listens_for(DeclarativeBaseGuid, "mapper_configured", propagate=True)
+def listen_slots_index(mapper, cls):
+    # keep the name index of the slots in sync
+    event.listen(cls.slots, "append", index_slot_appended)
+    event.listen(cls.slots, "remove", index_slot_removed)
@@ -1,14 +1,19 @@
 from __future__ import unicode_literals
 
 import uuid
+from collections import defaultdict, Counter
+from fractions import Fraction
 
 from enum import Enum
-from sqlalchemy import Column, VARCHAR, ForeignKey, INTEGER
-from sqlalchemy.orm import relation, validates
+from sqlalchemy import Column, VARCHAR, ForeignKey, INTEGER, select, event
+from sqlalchemy.orm import relation, validates, object_session
 
-from .._common import CallableList
+from .commodity import Commodity, GncPriceError
+from .transaction import Split, Transaction
+from .._common import CallableList, gncnumeric_sums, fraction_to_decimal
 from .._declbase import DeclarativeBaseGuid
-from ..sa_extra import mapped_to_slot_property
+from ..sa_extra import mapped_to_slot_property, datetime_range_clauses, datetime_before_clause, \
+    datetime_on_or_before, in_batches, flush_pending_changes
 
 root_types = {"ROOT"}
 asset_types = {'RECEIVABLE', 'MUTUAL', 'CASH', 'ASSET', 'BANK', 'STOCK'}
@@ -78,6 +83,276 @@ def _is_parent_child_types_consistent(type_parent, type_child, control_mode):
     return False
 
 
+def _account_subtree_guids(session, account_guid):
+    """Return the list of guids of an account and all its descendants (from the account index of the session)"""
+    return AccountIndex.of(session).subtree_guids(account_guid)
+
+
+def _account_subtree_cte(account_guid):
+    """Return a recursive CTE with the guids of an account and of all its descendants (resolved by the database
+    from accounts.parent_guid)"""
+    accounts = Account.__table__
+    tree = select([accounts.c.guid]).where(accounts.c.guid == account_guid).cte("account_tree", recursive=True)
+    return tree.union_all(select([accounts.c.guid]).where(accounts.c.parent_guid == tree.c.guid))
+
+
+def _splits_query(session, account_guid, start=None, end=None, recurse=True):
+    """Return a query of the splits of an account (and of its descendants if recurse is True) posted between
+    start and end (both included), ordered by post_date and streamed by batches of 1000 splits"""
+    query = session.query(Split).join(Transaction, Split.transaction_guid == Transaction.guid)
+    if recurse:
+        tree = _account_subtree_cte(account_guid)
+        query = query.join(tree, Split.account_guid == tree.c.guid)
+    else:
+        query = query.filter(Split.account_guid == account_guid)
+
+    return query \
+        .filter(*datetime_range_clauses(session, Transaction._post_date, start, end)) \
+        .order_by(Transaction._post_date, Split.value) \
+        .yield_per(1000)
+
+
+def _quantity_sums(session, account_guids=None, at_date=None, before=None):
+    """Return a dict with the exact sum (as a Fraction) of the quantities of the splits of each account
+    (keyed by (account guid, commodity guid)), optionally restricted to the splits posted on or before at_date
+    and/or strictly before before. If account_guids is None, the sums are computed for all accounts.
+
+    The sums are computed exactly in SQL with :func:`piecash._common.gncnumeric_sums`."""
+    from_obj = Split.__table__.join(Account.__table__, Split.account_guid == Account.guid)
+    where = []
+    if at_date is not None or before is not None:
+        from_obj = from_obj.join(Transaction.__table__, Split.transaction_guid == Transaction.guid)
+        where = datetime_range_clauses(session, Transaction._post_date, end=at_date)
+        if before is not None:
+            where.append(datetime_before_clause(session, Transaction._post_date, before))
+
+    if account_guids is None:
+        return gncnumeric_sums(session, Split._quantity_num, Split._quantity_denom,
+                               group_by=[Split.account_guid, Account.commodity_guid],
+                               where=where, from_obj=from_obj)
+
+    sums = {}
+    for batch in in_batches(account_guids):
+        sums.update(gncnumeric_sums(session, Split._quantity_num, Split._quantity_denom,
+                                    group_by=[Split.account_guid, Account.commodity_guid],
+                                    where=where + [Split.account_guid.in_(batch)],
+                                    from_obj=from_obj))
+    return sums
+
+
+def _conversion_factor(session, commodity_guid, currency, at_date=None):
+    """Return the factor (as a Fraction) to convert an amount in the commodity to an amount in the currency,
+    based on the last price (or inverse price) available on or before at_date"""
+    return _commodity_conversion_factor(session.query(Commodity).get(commodity_guid), currency, at_date)
+
+
+def _commodity_conversion_factor(commodity, currency, at_date=None):
+    """Return the factor of :func:`_conversion_factor` for a commodity object"""
+    if currency is None:
+        raise GncPriceError("A commodity must be given to convert balances expressed in different commodities")
+
+    try:
+        return Fraction(commodity.price_at(at_date, currency))
+    except GncPriceError:
+        pass
+    try:
+        return 1 / Fraction(currency.price_at(at_date, commodity))
+    except GncPriceError:
+        raise GncPriceError("No price available to convert {} to {}".format(commodity, currency))
+
+
+def _children_names(account):
+    """Return a Counter of the names of the children of the account.
+
+    During the validation of a book, the counters are cached (by parent) so that checking the name of each
+    new child of a parent does not scan all the children of the parent again."""
+    cache = getattr(object_session(account), "_children_names", None)
+    if cache is None or account.guid is None:
+        return Counter(acc.name for acc in account.children)
+
+    names = cache.get(account.guid)
+    if names is None:
+        names = cache[account.guid] = Counter(acc.name for acc in account.children)
+    return names
+
+
+class AccountIndex(object):
+    """
+    In memory index of the tree of the accounts of a session: fullnames of the accounts (used by
+    :attr:`Account.fullname` and to find accounts by fullname) and pre/post-order numbering of the accounts
+    (used to get the descendants of an account as a slice of the accounts in pre-order).
+
+    The index is computed from a single query on the accounts table. As the query does not flush, the index is
+    flagged as stale when the name or the parent of an account changes or when an account is attached to the
+    session and is not used for lookups until the next flush (or rollback), which drops it.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self._fullnames = None
+        self._guids = None
+        # guids of the accounts in pre-order and, for each account guid, the position of the account in this
+        # list (pre) and the position following its last descendant (post)
+        self._order = None
+        self._pre = None
+        self._post = None
+        # True if accounts have been changed or attached to the session since the last flush
+        self._stale = False
+
+    @staticmethod
+    def of(session):
+        """Return the AccountIndex of the session (creating it if needed)"""
+        index = getattr(session, "_account_index", None)
+        if index is None:
+            index = session._account_index = AccountIndex(session)
+        return index
+
+    def _build(self):
+        accounts = {guid: (name, parent_guid)
+                    for guid, name, parent_guid in self.session.execute(select([Account.guid,
+                                                                                 Account.name,
+                                                                                 Account.parent_guid]))}
+        fullnames = {}
+        for guid in accounts:
+            # walk up the tree until an account with a known fullname (or the root) is found
+            path = []
+            while guid is not None and guid not in fullnames:
+                path.append(guid)
+                guid = accounts[guid][1]
+
+            for guid in reversed(path):
+                name, parent_guid = accounts[guid]
+                if parent_guid is None:
+                    fullnames[guid] = u""
+                else:
+                    pfn = fullnames[parent_guid]
+                    fullnames[guid] = u"{}:{}".format(pfn, name) if pfn else name
+
+        children = defaultdict(list)
+        for guid, (name, parent_guid) in accounts.items():
+            children[parent_guid].append((name, guid))
+
+        # number the accounts with a depth first traversal of the tree (children sorted by name)
+        order, pre, post = [], {}, {}
+        to_visit = [(guid, False) for name, guid in sorted(children[None], reverse=True)]
+        while to_visit:
+            guid, visited = to_visit.pop()
+            if visited:
+                post[guid] = len(order)
+                continue
+            pre[guid] = len(order)
+            order.append(guid)
+            to_visit.append((guid, True))
+            to_visit.extend((child, False) for name, child in sorted(children[guid], reverse=True))
+
+        return fullnames, order, pre, post
+
+    def _load(self, pending=True):
+        """Return the fullnames and the pre/post-order numbering of the accounts (or None if there are
+        pending changes on accounts and pending is False)"""
+        if self._fullnames is None:
+            if self._stale:
+                return self._build() if pending else None
+            self._fullnames, self._order, self._pre, self._post = self._build()
+        return self._fullnames, self._order, self._pre, self._post
+
+    @property
+    def fullnames(self):
+        """Return the dict of the fullnames of the accounts (keyed by account guid) as stored in the database.
+
+        The dict is only kept in the index if no account has been changed since the last flush."""
+        return self._load()[0]
+
+    def fullname_of(self, account):
+        """Return the fullname of the account from the index (or None if the index cannot be used)"""
+        data = self._load(pending=False)
+        if data is None:
+            return None
+        return data[0].get(account.guid)
+
+    def account_of(self, fullname):
+        """Return the account with the fullname from the index (or None if not found or if the index cannot be used)"""
+        if self._load(pending=False) is None:
+            return None
+        if self._guids is None:
+            self._guids = {fn: guid for guid, fn in self._fullnames.items()}
+        guid = self._guids.get(fullname)
+        if guid is None:
+            return None
+        account = self.session.query(Account).get(guid)
+        # accounts deleted in the session are still in the database until the next flush
+        if account is None or account in self.session.deleted:
+            return None
+        return account
+
+    def subtree_guids(self, account_guid):
+        """Return the list of the guids of an account and of all its descendants (in pre-order) as stored in
+        the database"""
+        fullnames, order, pre, post = self._load()
+        if account_guid not in pre:
+            return [account_guid]
+        return order[pre[account_guid]:post[account_guid]]
+
+    def subtree_clause(self, column, account_guid):
+        """Return a clause testing if the account guid in column is the guid of the account or of one of its
+        descendants (with a recursive CTE to avoid the limit of parameters of some backends on large subtrees)"""
+        dialect = self.session.get_bind().dialect
+        if (dialect.name == "sqlite" and dialect.dbapi.sqlite_version_info < (3, 8, 3)) or \
+                (dialect.name == "mysql" and (dialect.server_version_info or ()) < (8,)):
+            # no recursive CTE on these backends
+            return column.in_(self.subtree_guids(account_guid))
+        return column.in_(select([_account_subtree_cte(account_guid).c.guid]))
+
+    def invalidate(self):
+        """Drop the index (it is rebuilt on next use)"""
+        self._fullnames = None
+        self._guids = None
+        self._order = self._pre = self._post = None
+
+    def mark_stale(self):
+        """Drop the index and flag it as stale until the next flush"""
+        self.invalidate()
+        self._stale = True
+
+    @staticmethod
+    def account_changed(target, value, oldvalue, initiator):
+        """Flag the index of the session of the account as stale when its name or its parent changes"""
+        session = object_session(target)
+        if session is not None and value is not oldvalue:
+            AccountIndex.of(session).mark_stale()
+
+    @staticmethod
+    def before_attach(session, instance):
+        """Flag the index as stale when an account is attached to the session"""
+        if isinstance(instance, Account):
+            AccountIndex.of(session).mark_stale()
+
+    @staticmethod
+    def after_flush(session, flush_context):
+        """Drop the index if accounts have been created, changed or deleted"""
+        index = getattr(session, "_account_index", None)
+        if index is None:
+            return
+        if index._stale:
+            index.invalidate()
+            index._stale = False
+            return
+        if index._fullnames is None:
+            return
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(obj, Account):
+                index.invalidate()
+                return
+
+    @staticmethod
+    def after_rollback(session):
+        """Drop the index as the changes on accounts may have been rolled back"""
+        index = getattr(session, "_account_index", None)
+        if index is not None:
+            index.invalidate()
+            index._stale = False
+
+
 class Account(DeclarativeBaseGuid):
     """
     A GnuCash Account which is specified by its name, type and commodity.
@@ -219,10 +494,10 @@ class Account(DeclarativeBaseGuid):
                 raise ValueError("Child type '{}' is not consistent with parent type {}".format(
                     self.type, self.parent.type))
 
-            for acc in self.parent.children:
-                if acc.name == self.name and acc != self:
-                    raise ValueError("{} has two children with the same name {} : {} and {}".format(self.parent, self.name,
-                                                                                                    self, acc))
+            if _children_names(self.parent)[self.name] > 1:
+                acc = next(acc for acc in self.parent.children if acc.name == self.name and acc != self)
+                raise ValueError("{} has two children with the same name {} : {} and {}".format(self.parent, self.name,
+                                                                                                self, acc))
         else:
             if self.type in root_types:
                 if self.name not in ['Template Root', 'Root Account']:
@@ -242,6 +517,13 @@ class Account(DeclarativeBaseGuid):
 
     @property
     def fullname(self):
+        session = object_session(self)
+        if session is not None and self.guid is not None:
+            # use the fullnames cached in the index of the session
+            fullname = AccountIndex.of(session).fullname_of(self)
+            if fullname is not None:
+                return fullname
+
         if self.parent:
             pfn = self.parent.fullname
             if pfn:
@@ -251,15 +533,80 @@ class Account(DeclarativeBaseGuid):
         else:
             return u""
 
-
-    def get_balance(self):
+    def get_balance(self, at_date=None, recurse=False, commodity=None):
         """
         Returns the balance of the account expressed in account's commodity/currency.
         If this is a stock/fund account, it will return the number of shares held.
         If this is a currency account, it will be in account's currency.
+
+        The balance is computed with a single SQL aggregate on the quantities of the splits (using exact integer
+        arithmetic on their numerators and denominators).
+
+        Args:
+            at_date (:class:`datetime.date` or :class:`datetime.datetime`): if given, only take into account
+                the splits posted on or before at_date
+            recurse (bool): True to include the balances of all the sub-accounts
+            commodity (:class:`piecash.core.commodity.Commodity`): the commodity in which the balance is expressed
+                (by default, the commodity of the account). Balances of accounts in another commodity are converted
+                with the last price available on or before at_date.
+
+        Returns:
+            :class:`decimal.Decimal`: the balance of the account
         """
-        return sum([sp.quantity for sp in self.splits]) * self.sign
+        if commodity is None:
+            commodity = self.commodity
+
+        session = object_session(self)
+        if session is None:
+            # the account is not attached to a book, its balance is summed in python on its splits
+            balance = Fraction(0)
+            accounts = [self]
+            while accounts:
+                acc = accounts.pop()
+                if recurse:
+                    accounts.extend(acc.children)
+                quantity = sum((Fraction(sp.quantity) for sp in acc.splits
+                                if at_date is None or datetime_on_or_before(sp.transaction.post_date, at_date)),
+                               Fraction(0))
+                if acc.commodity is not commodity:
+                    quantity *= _commodity_conversion_factor(acc.commodity, commodity, at_date)
+                balance += quantity
+            return fraction_to_decimal(balance * self.sign)
+
+        flush_pending_changes(session)
+
+        account_guids = _account_subtree_guids(session, self.guid) if recurse else [self.guid]
+
+        balance = Fraction(0)
+        factors = {}
+        for (account_guid, commodity_guid), quantity in _quantity_sums(session, account_guids, at_date).items():
+            if commodity is None or commodity_guid != commodity.guid:
+                if commodity_guid not in factors:
+                    factors[commodity_guid] = _conversion_factor(session, commodity_guid, commodity, at_date)
+                quantity *= factors[commodity_guid]
+            balance += quantity
+
+        # apply the sign on the Fraction to not return Decimal('-0') for empty credit accounts
+        return fraction_to_decimal(balance * self.sign)
+
+    def subtree_splits(self, start=None, end=None):
+        """
+        Returns the splits of the account and of all its sub-accounts posted between start and end.
+
+        The sub-accounts are resolved by the database with a recursive query on the accounts joined to the splits
+        and the transactions (instead of walking the children of each account) and the splits are streamed
+        by batches.
 
+        Args:
+            start (:class:`datetime.date` or :class:`datetime.datetime`): if given, only the splits posted on
+                or after start
+            end (:class:`datetime.date` or :class:`datetime.datetime`): if given, only the splits posted on
+                or before end
+
+        Returns:
+            :class:`sqlalchemy.orm.query.Query`: the query of the splits (ordered by post_date)
+        """
+        return _splits_query(object_session(self), self.guid, start=start, end=end)
 
     @property
     def sign(self):
@@ -274,3 +621,8 @@ class Account(DeclarativeBaseGuid):
             return u"Account<{acc.fullname}[{acc.commodity.mnemonic}]>".format(acc=self)
         else:
             return u"Account<{acc.fullname}>".format(acc=self)
+
+
+event.listen(Account.name, "set", AccountIndex.account_changed)
+event.listen(Account.parent, "set", AccountIndex.account_changed)
+event.listen(Account.parent_guid, "set", AccountIndex.account_changed)
@@ -1,19 +1,191 @@
+import datetime
 import locale
+import uuid
 import warnings
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from decimal import Decimal
+from fractions import Fraction
 from operator import attrgetter
-from sqlalchemy import Column, VARCHAR, ForeignKey
-from sqlalchemy.orm import relation, aliased, joinedload
+from sqlalchemy import Column, VARCHAR, ForeignKey, String, select, inspect, and_, or_, type_coerce
+from sqlalchemy.orm import relation, aliased, joinedload, join
+
+try:
+    from sqlalchemy.orm import selectinload
+except ImportError:
+    # SQLAlchemy < 1.2
+    from sqlalchemy.orm import subqueryload as selectinload
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.orm.base import instance_state
+from sqlalchemy.orm.util import identity_key
 from sqlalchemy.orm.exc import NoResultFound
 from . import factories
-from .account import Account
+from .account import Account, AccountIndex, positive_types, _account_subtree_guids, _quantity_sums, _conversion_factor
+from .account import _splits_query
 from .commodity import Commodity, Price
 from .transaction import Split, Transaction
 from ..business.invoice import Invoice
-from .._common import CallableList, GnucashException
+from .._common import QueryCallableList, GnucashException, GncValidationError, GncImbalanceError, fraction_to_decimal
+from .._common import to_decimal, decimal_to_gncnumeric
 from .._declbase import DeclarativeBaseGuid
-from ..sa_extra import kvp_attribute
+from ..kvp import Slot, KVP_Type, preload_slots, slot_value_clause, create_slots_index
+from ..sa_extra import kvp_attribute, datetime_range_clauses, datetime_sort_key, in_batches, flush_pending_changes
+
+
+# fields of the DataFrame returned by splits_df (before any additional field)
+_splits_df_fields = ["guid", "value", "quantity", "memo", "transaction.guid", "transaction.description",
+                     "transaction.post_date", "transaction.currency.guid", "transaction.currency.mnemonic",
+                     "account.fullname", "account.commodity.guid", "account.commodity.mnemonic",
+                     ]
+
+
+def _splits_entities():
+    """Return the entities reachable from a split keyed by the prefix used in the fields of splits_df
+    (the commodities table is aliased for the transaction currency and for the account commodity)"""
+    return {
+        "": Split,
+        "transaction": Transaction,
+        "transaction.currency": aliased(Commodity, name="transaction_currency"),
+        "account": Account,
+        "account.commodity": aliased(Commodity, name="account_commodity"),
+    }
+
+
+def _account_fullnames(session):
+    """Return a dict with the fullname of each account (keyed by account guid) from the account index
+    of the session"""
+    return AccountIndex.of(session).fullnames
+
+
+def _splits_select_columns(fields, entities):
+    """Return the list of columns to select and the list of getters (one per field) used by
+    :func:`_splits_rows` to extract the value of each field of a split.
+
+    The first two columns are always the guid of the split and the guid of its account. A field that cannot
+    be mapped to a column is extracted through the ORM object with an attrgetter."""
+    columns = [Split.guid, Split.account_guid]
+
+    def add_column(col):
+        columns.append(col.label("c{}".format(len(columns))))
+        return len(columns) - 1
+
+    getters = []
+    for field in fields:
+        prefix, _, attr = field.rpartition(".")
+        entity = entities.get(prefix)
+        column_attrs = entity and inspect(entity).mapper.column_attrs
+
+        if entity is Account and attr == "fullname":
+            getters.append(("fullname", None))
+        elif entity is not None and (attr in column_attrs or "_" + attr in column_attrs):
+            col = getattr(entity, attr if attr in column_attrs else "_" + attr)
+            getters.append(("column", add_column(col)))
+        elif entity is not None and "_{}_num".format(attr) in column_attrs:
+            # gnc numeric stored as a numerator and a denominator
+            i_num = add_column(getattr(entity, "_{}_num".format(attr)))
+            i_denom = add_column(getattr(entity, "_{}_denom".format(attr)))
+            getters.append(("numeric", (i_num, i_denom)))
+        else:
+            getters.append(("orm", attrgetter(field)))
+
+    return columns, getters
+
+
+def _splits_select(columns, entities):
+    """Return the select statement on the splits (excluding the template splits) joined to their
+    transaction, account and commodities, ordered by post_date."""
+    account_commodity = entities["account.commodity"]
+    j = join(Split, Transaction, Split.transaction) \
+        .join(Account, Split.account) \
+        .join(account_commodity, Account.commodity) \
+        .join(entities["transaction.currency"], Transaction.currency)
+
+    return select(columns) \
+        .select_from(j) \
+        .where(account_commodity.mnemonic != "template") \
+        .order_by(Transaction._post_date, Split.value)
+
+
+def _splits_rows(session, rows, getters, fullnames=None):
+    """Convert the rows returned by a select built with :func:`_splits_select_columns` to lists of values"""
+    if fullnames is None and any(kind == "fullname" for kind, _ in getters):
+        fullnames = _account_fullnames(session)
+
+    splits = {}
+    if any(kind == "orm" for kind, _ in getters):
+        guids = [row[0] for row in rows]
+        for batch in in_batches(guids):
+            splits.update((sp.guid, sp) for sp in session.query(Split).filter(Split.guid.in_(batch)))
+
+    def extractor(kind, arg):
+        if kind == "column":
+            return lambda row: row[arg]
+        elif kind == "numeric":
+            i_num, i_denom = arg
+            return lambda row: None if row[i_num] is None else Decimal(row[i_num]) / row[i_denom]
+        elif kind == "fullname":
+            return lambda row: fullnames[row[1]]
+        else:
+            return lambda row: arg(splits[row[0]])
+
+    extractors = [extractor(kind, arg) for kind, arg in getters]
+
+    return [[ext(row) for ext in extractors] for row in rows]
+
+
+def _preload_accounts(session):
+    """accounts with their commodity and their children: 2 queries"""
+    accounts = session.query(Account).options(joinedload(Account.commodity),
+                                              selectinload(Account.children)).all()
+    return accounts,
+
+
+def _preload_reports(session):
+    """accounts with their commodity, their children and their splits (with their transaction, its currency
+    and their lot): 3 queries"""
+    accounts = session.query(Account).options(joinedload(Account.commodity),
+                                              selectinload(Account.children),
+                                              selectinload(Account.splits).joinedload(Split.transaction)
+                                              .joinedload(Transaction.currency),
+                                              selectinload(Account.splits).joinedload(Split.lot),
+                                              ).all()
+    # the splits come from the accounts (no second query on the splits)
+    splits = sorted((sp for acc in accounts for sp in acc.splits),
+                    key=lambda sp: (sp.transaction.post_date, sp.value))
+    return accounts, splits
+
+
+def _preload_ledger(session):
+    """commodities, accounts with their commodity and their children, transactions with their splits and their
+    slots (notes) and prices: 7 queries"""
+    commodities = session.query(Commodity).all()
+    accounts, = _preload_accounts(session)
+    transactions = preload_slots(session,
+                                 session.query(Transaction).options(selectinload(Transaction.splits)))
+    prices = session.query(Price).all()
+    return accounts, transactions, prices, commodities
+
+
+def _preload_business(session):
+    """customers, vendors, employees, bill terms, tax tables with their entries and invoices with their entries:
+    8 queries"""
+    from ..business import Customer, Vendor, Employee, Billterm, Taxtable
+
+    customers = session.query(Customer).all()
+    vendors = session.query(Vendor).all()
+    employees = session.query(Employee).all()
+    billterms = session.query(Billterm).all()
+    taxtables = session.query(Taxtable).options(selectinload(Taxtable.entries)).all()
+    invoices = session.query(Invoice).options(selectinload(Invoice.entries)).all()
+    return customers, vendors, employees, billterms, taxtables, invoices
+
+
+# profiles usable with book.preload(profile) and open_book(preload=profile)
+preload_profiles = {
+    "accounts": _preload_accounts,
+    "reports": _preload_reports,
+    "ledger": _preload_ledger,
+    "business": _preload_business,
+}
 
 
 class Book(DeclarativeBaseGuid):
@@ -193,9 +365,14 @@ class Book(DeclarativeBaseGuid):
         txs = list(txs)
         txs.sort(key=lambda x: sort_order[type(x)])
 
-        # for each object, validate it
-        for tx in txs:
-            tx.validate()
+        # for each object, validate it (with a cache of the names of the children of the accounts
+        # shared by the validation of all the accounts)
+        session._children_names = {}
+        try:
+            for tx in txs:
+                tx.validate()
+        finally:
+            session._children_names = None
 
     _trading_accounts = None
 
@@ -238,6 +415,254 @@ class Book(DeclarativeBaseGuid):
         # self.flush()
         return tacc
 
+    def ensure_accounts(self, paths, type_map=None, commodity=None):
+        """
+        Return the accounts with the given fullnames, creating the missing accounts (and their missing parents)
+        in a single pass with a single flush.
+
+        The existing accounts are loaded with one query and indexed by parent and name so that each path is
+        resolved without scanning the children of the accounts.
+
+        The type of a new account is taken from the type_map for its fullname or for the closest of its
+        parents in the type_map (e.g. {"Assets": "ASSET", "Assets:Receivables": "RECEIVABLE"}) and
+        otherwise from the type of its parent.
+
+        Args:
+            paths (iterable of str): the fullnames of the accounts (e.g. "Assets:Bank:Checking")
+            type_map (dict): the types of the new accounts keyed by fullname
+            commodity (:class:`piecash.core.commodity.Commodity`): the commodity of the new accounts
+              (default to the default currency of the book)
+
+        Returns:
+            list of :class:`piecash.core.account.Account`: the accounts for each path
+
+        Raises:
+            ValueError: if the type of a new account cannot be found
+        """
+        session = self.session
+        session.flush()
+        type_map = type_map or {}
+        if commodity is None:
+            commodity = self.default_currency
+
+        root = self.root_account
+        accounts = session.query(Account).all()
+
+        # index the children of each account by name (and give its children collection to each account
+        # to avoid a lazy load per parent when appending the new accounts)
+        children = defaultdict(list)
+        for acc in accounts:
+            children[acc.parent_guid].append(acc)
+        index = {}
+        for acc in accounts:
+            if "children" not in instance_state(acc).dict:
+                set_committed_value(acc, "children", children[acc.guid])
+            index[acc.parent_guid, acc.name] = acc
+
+        result = []
+        for path in paths:
+            parent, fullname = root, None
+            for name in path.split(":"):
+                fullname = name if fullname is None else u"{}:{}".format(fullname, name)
+                # new accounts have no guid until the flush and are indexed by id
+                key = (parent.guid or id(parent), name)
+                acc = index.get(key)
+                if acc is None:
+                    type = self._account_type(fullname, type_map, parent)
+                    acc = index[key] = Account(name=name, type=type, commodity=commodity, parent=parent, book=self)
+                parent = acc
+            result.append(parent)
+
+        session.flush()
+        return result
+
+    @staticmethod
+    def _account_type(fullname, type_map, parent):
+        """Return the type of a new account from the type_map or from its parent"""
+        path = fullname
+        while path:
+            if path in type_map:
+                return type_map[path]
+            path, _, _ = path.rpartition(":")
+        if parent.type != "ROOT":
+            return parent.type
+        raise ValueError("Could not find the type of the account '{}' in the type_map".format(fullname))
+
+    def bulk_insert_transactions(self, rows):
+        """
+        Insert transactions with their splits (and their slots) with a few 'executemany' statements
+        instead of creating :class:`piecash.core.transaction.Transaction` and :class:`piecash.core.transaction.Split`
+        objects (that are tracked and validated one by one at each flush).
+
+        Each row is a dict with the keys:
+
+        - splits: list of dicts with the keys account (an :class:`piecash.core.account.Account` or its fullname),
+          value, quantity (default to value), memo and action (default to "", or to "Buy"/"Sell" for a split
+          in a commodity different from the currency of the transaction as done by Split.validate)
+        - currency: the currency of the transaction (default to the default currency of the book)
+        - post_date (:class:`datetime.date` or :class:`datetime.datetime`), enter_date (default to now)
+        - description, num and notes (optional)
+
+        The checks done by Transaction.validate and Split.validate (currency of the transaction, placeholder accounts,
+        balance of the transaction, quantity vs value of the splits) are done on the whole batch before inserting
+        anything. Contrary to the objects, no Price is created for the splits in a commodity different from the
+        currency of the transaction and transactions needing splits on trading accounts are refused.
+
+        The inserted transactions are not in the session (they can be loaded as usual, for instance
+        with book.transactions) and the changes are saved with book.save() as usual.
+
+        Args:
+            rows (iterable of dict): the transactions to insert
+
+        Returns:
+            list of str: the guids of the inserted transactions
+
+        Raises:
+            GncValidationError: if a transaction is not valid (nothing is inserted)
+        """
+        session = self.session
+        session.flush()
+
+        # load the information required to validate the rows (2 queries)
+        accounts = {guid: (commodity_guid, scu, placeholder)
+                    for guid, commodity_guid, scu, placeholder in session.execute(
+                select([Account.guid, Account.commodity_guid, Account._commodity_scu, Account._placeholder]))}
+        commodities = {guid: (namespace, fraction)
+                       for guid, namespace, fraction in session.execute(
+                select([Commodity.guid, Commodity.namespace, Commodity.fraction]))}
+        guid_of_fullname = {}
+
+        def account_guid(account):
+            if isinstance(account, Account):
+                return account.guid
+            if not guid_of_fullname:
+                guid_of_fullname.update((fullname, guid)
+                                        for guid, fullname in _account_fullnames(session).items())
+            try:
+                return guid_of_fullname[account]
+            except KeyError:
+                raise GncValidationError("Account '{}' does not exist".format(account))
+
+        now = datetime.datetime.today().replace(microsecond=0)
+        default_currency = None
+        transactions, splits, dates_posted, notes = [], [], [], []
+        currencies, values, cross_commodities = set(), defaultdict(int), set()
+        for row in rows:
+            currency = row.get("currency")
+            if currency is None:
+                if default_currency is None:
+                    default_currency = self.default_currency
+                currency = default_currency
+            currency_fraction = commodities[currency.guid][1]
+            currencies.add(currency.guid)
+
+            post_date = row.get("post_date") or now
+            if not isinstance(post_date, datetime.datetime):
+                post_date = datetime.datetime.combine(post_date, datetime.time())
+            post_date = post_date.replace(hour=11, minute=0, second=0, microsecond=0)
+
+            tx_guid = uuid.uuid4().hex
+            transactions.append({"guid": tx_guid,
+                                 "currency_guid": currency.guid,
+                                 "num": row.get("num", ""),
+                                 "post_date": post_date,
+                                 "enter_date": row.get("enter_date") or now,
+                                 "description": row.get("description", "")})
+            dates_posted.append({"obj_guid": tx_guid,
+                                 "name": "date-posted",
+                                 "slot_type": KVP_Type.KVP_TYPE_GDATE,
+                                 "gdate_val": post_date.date()})
+            if row.get("notes") is not None:
+                notes.append({"obj_guid": tx_guid,
+                              "name": "notes",
+                              "slot_type": KVP_Type.KVP_TYPE_STRING,
+                              "string_val": row["notes"]})
+
+            for sp in row["splits"]:
+                acc_guid = account_guid(sp["account"])
+                commodity_guid, scu, placeholder = accounts[acc_guid]
+                value = to_decimal(sp["value"])
+                quantity = value if sp.get("quantity") is None else to_decimal(sp["quantity"])
+                action = sp.get("action", "")
+                if commodity_guid == currency.guid:
+                    if quantity != value:
+                        raise GncValidationError("The split has a quantity different from value "
+                                                 "while the transaction currency and the account commodity is the same")
+                else:
+                    if quantity.is_signed() != value.is_signed():
+                        raise GncValidationError("The split quantity has not the same sign as the split value")
+                    cross_commodities.add(tx_guid)
+                    if action == "":
+                        action = "Sell" if quantity.is_signed() else "Buy"
+                if placeholder:
+                    raise GncValidationError("Account '{}' used in the transaction is a placeholder".format(
+                        sp["account"]))
+
+                value_num, value_denom = decimal_to_gncnumeric(value, currency_fraction)
+                quantity_num, quantity_denom = decimal_to_gncnumeric(quantity, scu)
+                values[tx_guid] += value_num
+                splits.append({"guid": uuid.uuid4().hex,
+                               "tx_guid": tx_guid,
+                               "account_guid": acc_guid,
+                               "memo": sp.get("memo", ""),
+                               "action": action,
+                               "reconcile_state": "n",
+                               "value_num": value_num,
+                               "value_denom": value_denom,
+                               "quantity_num": quantity_num,
+                               "quantity_denom": quantity_denom})
+
+        # checks on the whole batch
+        for currency_guid in currencies:
+            if commodities[currency_guid][0] != "CURRENCY":
+                raise GncValidationError("You are assigning a non currency commodity to a transaction")
+        if any(values.values()):
+            raise GncImbalanceError("{} transaction(s) are not balanced on their value".format(
+                sum(1 for v in values.values() if v)))
+        if cross_commodities and self.use_trading_accounts:
+            raise GncValidationError("Transactions requiring trading accounts cannot be inserted in bulk")
+
+        for table, params in [(Transaction.__table__, transactions),
+                              (Split.__table__, splits),
+                              (Slot.__table__, dates_posted),
+                              (Slot.__table__, notes)]:
+            if params:
+                session.execute(table.insert(), params)
+
+        if transactions:
+            # the rows are not tracked by the session, flag it as modified (for book.is_saved)
+            session._is_modified = True
+
+        # refresh the splits of the accounts already loaded
+        for acc_guid in {sp["account_guid"] for sp in splits}:
+            acc = session.identity_map.get(identity_key(Account, acc_guid))
+            if acc is not None:
+                session.expire(acc, ["splits"])
+
+        return [tx["guid"] for tx in transactions]
+
+    def bulk_transactions(self, batch_size=10000):
+        """
+        Return a context manager to insert transactions by batches with :meth:`bulk_insert_transactions`.
+
+        Example::
+
+            with book.bulk_transactions() as bulk:
+                for line in bank_feed:
+                    bulk.add({"post_date": line.date,
+                              "description": line.label,
+                              "splits": [{"account": "Assets:Current Account", "value": line.amount},
+                                         {"account": "Expenses:Unknown", "value": -line.amount}]})
+            book.save()
+
+        Args:
+            batch_size (int): the number of transactions inserted at once
+
+        Returns:
+            :class:`BulkTransactions`
+        """
+        return BulkTransactions(self, batch_size)
+
     # add session alike functions
     def add(self, obj):
         """Add an object to the book (to be used if object not linked in any way to the book)"""
@@ -317,6 +742,53 @@ class Book(DeclarativeBaseGuid):
         else:
             return self.session.query(cls)
 
+    def query_by_slot(self, cls, path, value=None):
+        """
+        Return a query on the objects of type cls having a slot at the given path (and with the given value
+        if specified). The query joins the slots table once per level of the path, so that no slot is loaded.
+
+        Example::
+
+            # all accounts with a red color
+            red_accounts = book.query_by_slot(Account, "color", "red").all()
+
+            # all transactions created from a scheduled transaction
+            txs = book.query_by_slot(Transaction, "from-sched-xaction").all()
+
+        The index created by :meth:`create_slots_index` speeds up these queries on large books.
+
+        Args:
+            cls (class): the class of the objects (Account, Transaction, Split, ...)
+            path (str): the path of the slot (with "/" to separate the levels of nested frames)
+            value: the value of the slot (a simple value or an object for a GUID slot), None for any value
+
+        Returns:
+            :class:`sqlalchemy.orm.query.Query`: the query on the objects
+        """
+        slots = Slot.__table__
+        query = self.session.query(cls)
+        parent_guid = cls.guid
+        names = path.split("/")
+        for i in range(len(names)):
+            slot = slots.alias("slot_{}".format(i))
+            query = query.join(slot, and_(slot.c.obj_guid == parent_guid,
+                                          slot.c.name == "/".join(names[:i + 1])))
+            parent_guid = slot.c.guid_val
+        if value is not None:
+            query = query.filter(slot_value_clause(slot, value))
+        return query
+
+    def create_slots_index(self):
+        """
+        Create (if it does not exist yet) an index on slots(name, obj_guid) to speed up :meth:`query_by_slot`.
+
+        The index is created in the current transaction (it is kept with book.save()) and is ignored by GnuCash.
+
+        Returns:
+            bool: True if the index has been created
+        """
+        return create_slots_index(self.session.connection())
+
     @property
     def transactions(self):
         """
@@ -325,7 +797,7 @@ class Book(DeclarativeBaseGuid):
         """
         from .transaction import Transaction
 
-        return CallableList(self.session.query(Transaction))
+        return QueryCallableList(self.session.query(Transaction))
 
     @property
     def splits(self):
@@ -335,7 +807,87 @@ class Book(DeclarativeBaseGuid):
         """
         from .transaction import Split
 
-        return CallableList(self.session.query(Split))
+        return QueryCallableList(self.session.query(Split))
+
+    def iter_transactions(self, batch_size=1000, with_splits=True, start=None, end=None):
+        """
+        Iterate on the transactions of the book posted between start and end (ordered by post_date) by loading
+        them by batches of batch_size transactions (with their splits if with_splits is True).
+
+        The batches are retrieved with a keyset pagination on (post_date, guid) (the transactions without post_date
+        come first) and each batch is removed from the session once iterated so that the memory used does not
+        depend on the size of the book.
+        A batch is kept in the session if the session has changes when the batch is finished (to not lose
+        the changes nor skip their validation when saving).
+
+        Args:
+            batch_size (int): the number of transactions loaded by query
+            with_splits (bool): True to load the splits of the transactions of each batch with one query
+            start (:class:`datetime.date` or :class:`datetime.datetime`): if given, only the transactions posted
+                on or after start
+            end (:class:`datetime.date` or :class:`datetime.datetime`): if given, only the transactions posted
+                on or before end
+
+        Returns:
+            iterator of :class:`piecash.core.transaction.Transaction`: the transactions
+        """
+        session = self.session
+        # the keyset compares the post_date as sorted in the database
+        post_date = type_coerce(datetime_sort_key(session, Transaction._post_date), String)
+        # the transactions without post_date (NULL) come first on all backends
+        query = session.query(Transaction, post_date) \
+            .filter(*datetime_range_clauses(session, Transaction._post_date, start, end)) \
+            .order_by(Transaction._post_date.isnot(None), post_date, Transaction.guid)
+        if with_splits:
+            query = query.options(selectinload(Transaction.splits))
+
+        last = None
+        while True:
+            if last is None:
+                rows = query.limit(batch_size).all()
+            else:
+                last_post_date, last_guid = last
+                if last_post_date is None:
+                    after_last = or_(Transaction._post_date.isnot(None),
+                                     and_(Transaction._post_date.is_(None), Transaction.guid > last_guid))
+                else:
+                    after_last = or_(post_date > last_post_date,
+                                     and_(post_date == last_post_date, Transaction.guid > last_guid))
+                rows = query.filter(after_last).limit(batch_size).all()
+            if not rows:
+                return
+
+            batch = [tr for tr, _ in rows]
+            for tr in batch:
+                yield tr
+            last = rows[-1][1], batch[-1].guid
+
+            # remove the batch from the session (with the splits and the slots through the 'expunge' cascade)
+            # if there is no change to keep track of
+            if not (session.new or session.dirty or session.deleted or getattr(session, "_all_changes", None)):
+                for tr in batch:
+                    session.expunge(tr)
+
+    def splits_for(self, account, recurse=True, start=None, end=None):
+        """
+        Return the splits of an account (and of all its sub-accounts if recurse is True) posted between start and
+        end (see :meth:`piecash.core.account.Account.subtree_splits`).
+
+        Args:
+            account (:class:`piecash.core.account.Account` or str): the account or its fullname
+                (e.g. "Expenses:Travel")
+            recurse (bool): True to include the splits of the sub-accounts
+            start (:class:`datetime.date` or :class:`datetime.datetime`): if given, only the splits posted on
+                or after start
+            end (:class:`datetime.date` or :class:`datetime.datetime`): if given, only the splits posted on
+                or before end
+
+        Returns:
+            :class:`sqlalchemy.orm.query.Query`: the query of the splits (ordered by post_date)
+        """
+        if not isinstance(account, Account):
+            account = self.accounts(fullname=account)
+        return _splits_query(self.session, account.guid, start=start, end=end, recurse=recurse)
 
     @property
     def accounts(self):
@@ -345,7 +897,11 @@ class Book(DeclarativeBaseGuid):
         """
         from .account import Account
 
-        return CallableList(self.session.query(Account).filter(Account.parent != None))
+        accounts = QueryCallableList(self.session.query(Account).filter(Account.parent != None))
+        # find accounts by fullname through the account index of the session (the root account is excluded)
+        index = AccountIndex.of(self.session)
+        accounts.finders = {"fullname": lambda fullname: index.account_of(fullname) if fullname else None}
+        return accounts
 
     @property
     def commodities(self):
@@ -355,7 +911,7 @@ class Book(DeclarativeBaseGuid):
         """
         from .commodity import Commodity
 
-        return CallableList(self.session.query(Commodity))
+        return QueryCallableList(self.session.query(Commodity))
 
     @property
     def invoices(self):
@@ -365,7 +921,7 @@ class Book(DeclarativeBaseGuid):
         """
         from .commodity import Commodity
 
-        return CallableList(self.session.query(Invoice))
+        return QueryCallableList(self.session.query(Invoice))
 
 
     @property
@@ -382,7 +938,7 @@ class Book(DeclarativeBaseGuid):
             # self.flush()
             return cur
 
-        cl = CallableList(self.session.query(Commodity).filter_by(namespace="CURRENCY"))
+        cl = QueryCallableList(self.session.query(Commodity).filter_by(namespace="CURRENCY"))
         cl.fallback = fallback
         return cl
 
@@ -394,7 +950,7 @@ class Book(DeclarativeBaseGuid):
         """
         from .commodity import Price
 
-        return CallableList(self.session.query(Price))
+        return QueryCallableList(self.session.query(Price))
 
     @property
     def customers(self):
@@ -404,7 +960,7 @@ class Book(DeclarativeBaseGuid):
         """
         from ..business import Customer
 
-        return CallableList(self.session.query(Customer))
+        return QueryCallableList(self.session.query(Customer))
 
     @property
     def vendors(self):
@@ -414,7 +970,7 @@ class Book(DeclarativeBaseGuid):
         """
         from ..business import Vendor
 
-        return CallableList(self.session.query(Vendor))
+        return QueryCallableList(self.session.query(Vendor))
 
     @property
     def employees(self):
@@ -424,7 +980,7 @@ class Book(DeclarativeBaseGuid):
         """
         from ..business import Employee
 
-        return CallableList(self.session.query(Employee))
+        return QueryCallableList(self.session.query(Employee))
 
     @property
     def taxtables(self):
@@ -434,7 +990,7 @@ class Book(DeclarativeBaseGuid):
         """
         from ..business import Taxtable
 
-        return CallableList(self.session.query(Taxtable))
+        return QueryCallableList(self.session.query(Taxtable))
 
     @property
     def query(self):
@@ -443,26 +999,72 @@ class Book(DeclarativeBaseGuid):
         """
         return self.session.query
 
-    def preload(self):
-        # preload list of accounts
-        accounts = self.session.query(Account).options(joinedload("splits").joinedload("transaction"),
-                                                       joinedload("children"),
-                                                       joinedload("commodity"),
-                                                       ).all()
+    def preload(self, profile="reports"):
+        """
+        Load at once the objects needed for a given job (to avoid the lazy loading of each relationship
+        of each object). The relationships are loaded with 'selectin' queries (batches of IN clauses)
+        instead of joins to avoid duplicating the rows of the parent objects.
+
+        The profiles are (with the number of queries emitted, knowing that a relationship loaded with
+        a 'selectin' query needs one more query for each additional batch of 500 parent objects and no query
+        if there is no parent object):
+
+        - "accounts": accounts with their commodity and their children: 2 queries. Returns (accounts,).
+        - "reports" (default): accounts with their commodity, their children and their splits (with their transaction,
+          its currency and their lot): 3 queries. Returns (accounts, splits) with the splits sorted by post_date.
+        - "ledger": commodities, accounts with their commodity and their children, transactions with their splits
+          and their slots and prices: 7 queries. Returns (accounts, transactions, prices, commodities).
+        - "business": customers, vendors, employees, bill terms, tax tables and invoices with their entries:
+          8 queries. Returns (customers, vendors, employees, billterms, taxtables, invoices).
+
+        As the session only keeps weak references to the objects, a reference to the returned objects should be kept
+        as long as the preloaded objects are needed.
+
+        Args:
+            profile (str): the name of the profile
+
+        Returns:
+            tuple: the lists of the loaded objects (see the profiles)
+
+        Raises:
+            ValueError: if the profile does not exist
+        """
+        try:
+            preload = preload_profiles[profile]
+        except KeyError:
+            raise ValueError("Unknown preload profile '{}' (should be one of {})".format(
+                profile, ", ".join(sorted(preload_profiles))))
+        return preload(self.session)
+
+    def preload_slots(self, objects, resolve_guids=False):
+        """
+        Load the slots of the objects (and of their frames) with one query per level of nesting
+        instead of one query per object (and per frame) when the slots are accessed.
 
-        # load all splits
-        splits = self.session.query(Split).join(Transaction).options(
-                                                   joinedload("account"),
-                                                   joinedload("lot")) \
-            .order_by(Transaction.post_date, Split.value).all()
+        Example::
 
-        return accounts, splits
+            transactions = book.preload_slots(book.query(Transaction).filter(Transaction.post_date >= start))
+            for tr in transactions:
+                print(tr.notes)
 
+        Args:
+            objects (iterable or :class:`sqlalchemy.orm.query.Query`): the objects (with slots) to preload
+            resolve_guids (bool): True to also load (with one query per class) the objects referred to by
+                the GUID slots (like the "from-sched-xaction" of transactions)
+
+        Returns:
+            list: the objects
+        """
+        return preload_slots(self.session, objects, resolve_guids=resolve_guids)
 
     def splits_df(self, additional_fields=None):
         """
         Return a pandas DataFrame with all splits (:class:`piecash.core.commodity.Split`) from the book
-        
+
+        The DataFrame is built from a single joined SQL query on the splits, transactions, accounts and
+        commodities tables (no ORM object is created). Fields in `additional_fields` that cannot be mapped
+        to a column (e.g. "lot.title") are retrieved through the ORM objects.
+
         :parameters: :class:`list`
 
         :return: :class:`pandas.DataFrame`
@@ -475,32 +1077,264 @@ class Book(DeclarativeBaseGuid):
         # Initialise default argument here
         additional_fields = additional_fields if additional_fields else []
 
-        # preload list of accounts
-        accounts = self.session.query(Account).all()
-
-        # preload list of commodities
-        commodities = self.session.query(Commodity).filter(Commodity.namespace != "template").all()
-
-        # preload list of transactions
-        transactions = self.session.query(Transaction).all()
+        # build dataframe. Adds additional transaction.guid field.
+        fields = _splits_df_fields + additional_fields
 
-        # load all splits
-        splits = self.session.query(Split).join(Transaction) \
-            .order_by(Transaction.post_date, Split.value).all()
+        query, row_getters = self._splits_select(fields)
 
-        # build dataframe. Adds additional transaction.guid field.
-        fields = ["guid", "value", "quantity", "memo", "transaction.guid", "transaction.description",
-                  "transaction.post_date", "transaction.currency.guid", "transaction.currency.mnemonic",
-                  "account.fullname", "account.commodity.guid", "account.commodity.mnemonic",
-                  ] + additional_fields
-        fields_getter = [attrgetter(fld) for fld in fields]
-        df_splits = pandas.DataFrame([[fg(sp) for fg in fields_getter]
-                                      for sp in splits], columns=fields)
-        df_splits = df_splits[df_splits["account.commodity.mnemonic"] != "template"]
+        rows = self.session.execute(query).fetchall()
+        df_splits = pandas.DataFrame(_splits_rows(self.session, rows, row_getters),
+                                     columns=fields)
         df_splits = df_splits.set_index("guid")
 
         return df_splits
 
+    def trial_balance(self, at_date=None, currency=None):
+        """
+        Return the balance of every account of the book (including the balance of its sub-accounts) as
+        an OrderedDict keyed by the fullname of the accounts (sorted by fullname).
+
+        The balances are computed with a single SQL aggregate on the quantities of all splits and rolled up to
+        the parent accounts in memory. For each account, the balance is the same as
+        ``account.get_balance(at_date=at_date, recurse=True, commodity=currency)``.
+
+        Args:
+            at_date (:class:`datetime.date` or :class:`datetime.datetime`): if given, only take into account
+                the splits posted on or before at_date
+            currency (:class:`piecash.core.commodity.Commodity`): the commodity in which the balances are expressed
+                (by default, the commodity of each account)
+
+        Returns:
+            :class:`collections.OrderedDict`: the balance (:class:`decimal.Decimal`) of each account
+        """
+        flush_pending_changes(self.session)
+
+        accounts = {guid: (parent_guid, commodity_guid, type)
+                    for guid, parent_guid, commodity_guid, type in self.session.execute(
+                select([Account.guid, Account.parent_guid, Account.commodity_guid, Account.type]))}
+        fullnames = _account_fullnames(self.session)
+
+        # sum of quantities of each account and of its sub-accounts per commodity
+        rolled_up = defaultdict(lambda: defaultdict(Fraction))
+        for (account_guid, commodity_guid), quantity in _quantity_sums(self.session, at_date=at_date).items():
+            guid = account_guid
+            while guid is not None:
+                rolled_up[guid][commodity_guid] += quantity
+                guid = accounts[guid][0]
+
+        factors = {}
+
+        def convert(commodity_guid, target_guid):
+            if (commodity_guid, target_guid) not in factors:
+                target = self.session.query(Commodity).get(target_guid) if target_guid else None
+                factors[commodity_guid, target_guid] = _conversion_factor(self.session, commodity_guid,
+                                                                          target, at_date)
+            return factors[commodity_guid, target_guid]
+
+        balances = []
+        # only keep the accounts under the root account (i.e. no template accounts)
+        for guid in _account_subtree_guids(self.session, self.root_account.guid)[1:]:
+            parent_guid, commodity_guid, type = accounts[guid]
+            target_guid = currency.guid if currency is not None else commodity_guid
+
+            balance = Fraction(0)
+            for cdty_guid, quantity in rolled_up[guid].items():
+                balance += quantity if cdty_guid == target_guid else quantity * convert(cdty_guid, target_guid)
+
+            sign = 1 if (type in positive_types) else -1
+            balances.append((fullnames[guid], fraction_to_decimal(balance * sign)))
+
+        return OrderedDict(sorted(balances))
+
+    def _running_balances(self, accounts, start=None, end=None):
+        """Return, for each account, the opening balance at start and the arrays (split guids, post dates,
+        running balances) of its splits posted between start and end (dates or datetimes), ordered as in the register.
+
+        The balances follow the sign convention of :meth:`piecash.core.account.Account.get_balance`."""
+        import numpy
+
+        flush_pending_changes(self.session)
+
+        account_guids = [acc.guid for acc in accounts]
+        opening = defaultdict(Fraction)
+        if start is not None:
+            for (account_guid, _), quantity in _quantity_sums(self.session, account_guids, before=start).items():
+                opening[account_guid] += quantity
+
+        # the splits are sorted as in the GnuCash register
+        query = select([Split.account_guid, Split.guid, Transaction._post_date,
+                        Split._quantity_num, Split._quantity_denom]) \
+            .select_from(join(Split, Transaction, Split.transaction)) \
+            .order_by(datetime_sort_key(self.session, Transaction._post_date), Transaction.num,
+                      datetime_sort_key(self.session, Transaction.enter_date), Transaction.guid)
+        for clause in datetime_range_clauses(self.session, Transaction._post_date, start, end):
+            query = query.where(clause)
+
+        rows = defaultdict(list)
+        for guids in in_batches(account_guids):
+            for row in self.session.execute(query.where(Split.account_guid.in_(guids))):
+                rows[row[0]].append(row[1:])
+
+        balances = []
+        for acc in accounts:
+            guids, post_dates, nums, denoms = zip(*rows[acc.guid]) if rows[acc.guid] else ((), (), (), ())
+            quantities = numpy.array([Decimal(num * acc.sign) / denom for num, denom in zip(nums, denoms)],
+                                     dtype=object)
+            # apply the sign before the conversion to not get Decimal('-0') for empty credit accounts
+            open_balance = fraction_to_decimal(opening[acc.guid] * acc.sign)
+            running = numpy.cumsum(quantities) + open_balance if len(quantities) else quantities
+            balances.append((acc, open_balance, guids, post_dates, quantities, running))
+
+        return balances
+
+    def running_balance_df(self, accounts, start=None, end=None):
+        """
+        Return a pandas DataFrame with the splits of the accounts posted between start and end and, for each split,
+        the running balance of its account (as in the GnuCash register).
+
+        Args:
+            accounts (list of :class:`piecash.core.account.Account`): the accounts
+            start (:class:`datetime.date`): only splits posted on or after start (the running balances include
+                the balance of the account before start)
+            end (:class:`datetime.date`): only splits posted on or before end
+
+        Returns:
+            :class:`pandas.DataFrame`: indexed by the guid of the splits with the columns
+            "account.fullname", "transaction.post_date", "quantity" and "running_balance"
+        """
+        try:
+            import pandas
+        except ImportError:
+            raise GnucashException("pandas is required to output dataframes")
+
+        fields = ["guid", "account.fullname", "transaction.post_date", "quantity", "running_balance"]
+        rows = []
+        for acc, _, guids, post_dates, quantities, running in self._running_balances(accounts, start, end):
+            fullname = acc.fullname
+            rows.extend([guid, fullname, post_date, quantity, balance]
+                        for guid, post_date, quantity, balance in zip(guids, post_dates, quantities, running))
+
+        return pandas.DataFrame(rows, columns=fields).set_index("guid")
+
+    def balance_series(self, accounts, start, end, freq="D"):
+        """
+        Return a pandas DataFrame with the balance of each account at the end of each period between start and end.
+
+        The balances are built from a single scan of the splits sorted by date (with a cumulative sum per account)
+        and follow the sign convention of :meth:`piecash.core.account.Account.get_balance`.
+
+        Args:
+            accounts (list of :class:`piecash.core.account.Account`): the accounts (one column per account)
+            start (:class:`datetime.date`): the first date of the series
+            end (:class:`datetime.date`): the last date of the series
+            freq (str): the pandas frequency of the series (e.g. "D", "W", "M")
+
+        Returns:
+            :class:`pandas.DataFrame`: indexed by the end of each period, with one column (named after the
+            fullname of the account) of :class:`decimal.Decimal` balances per account
+        """
+        try:
+            import pandas
+            import numpy
+        except ImportError:
+            raise GnucashException("pandas is required to output dataframes")
+
+        periods = pandas.date_range(start, end, freq=freq)
+        period_days = periods.values.astype("datetime64[D]")
+
+        columns = OrderedDict()
+        for acc, open_balance, _, post_dates, _, running in self._running_balances(accounts, start, end):
+            post_days = numpy.array([d.date() for d in post_dates], dtype="datetime64[D]")
+            # balance after the last split posted on or before the end of each period
+            balances = numpy.concatenate([numpy.array([open_balance], dtype=object), running])
+            columns[acc.fullname] = balances[numpy.searchsorted(post_days, period_days, side="right")]
+
+        return pandas.DataFrame(columns, index=periods, columns=list(columns))
+
+    def _splits_select(self, fields, start=None, end=None, account=None):
+        """Return the select statement and the row getters to retrieve the fields of the splits (see
+        :meth:`splits_df`) filtered on the post_date of their transaction and on an account subtree"""
+        flush_pending_changes(self.session)
+
+        entities = _splits_entities()
+        columns, row_getters = _splits_select_columns(fields, entities)
+        query = _splits_select(columns, entities)
+
+        for clause in datetime_range_clauses(self.session, Transaction._post_date, start, end):
+            query = query.where(clause)
+        if account is not None:
+            query = query.where(AccountIndex.of(self.session).subtree_clause(Split.account_guid, account.guid))
+
+        return query, row_getters
+
+    def _iter_rows(self, query, chunksize):
+        """Iterate on the rows of the select statement by lists of at most chunksize rows.
+
+        The rows are streamed (through a server-side cursor if the backend supports it) from a dedicated
+        connection so that the queries run on the session between two chunks do not interfere with the open
+        result (pymysql discards the rest of an unbuffered result when another query is run on the connection).
+        If the session has changes not yet saved (that a dedicated connection does not see), the rows are
+        fetched at once from the session.
+        With sqlite, the rows are streamed from the session (the cursors of a sqlite connection are independent
+        and the connections of an in memory database are shared)."""
+        if self.session.get_bind().dialect.name == "sqlite":
+            connection = self.session
+        elif self.session.is_saved:
+            connection = self.session.get_bind().connect()
+        else:
+            rows = self.session.execute(query).fetchall()
+            for i in range(0, len(rows), chunksize):
+                yield rows[i:i + chunksize]
+            return
+
+        try:
+            result = connection.execute(query.execution_options(stream_results=True))
+            try:
+                while True:
+                    rows = result.fetchmany(chunksize)
+                    if not rows:
+                        break
+                    yield rows
+            finally:
+                result.close()
+        finally:
+            if connection is not self.session:
+                connection.close()
+
+    def iter_splits_df(self, chunksize=10000, start=None, end=None, account=None, additional_fields=None):
+        """
+        Iterate on the splits (:class:`piecash.core.commodity.Split`) from the book as pandas DataFrames of at most
+        chunksize rows (with the same columns as :meth:`splits_df`), ordered by post_date.
+
+        The rows are streamed from the database (through a server-side cursor if the backend supports it, on a
+        dedicated connection) so that the memory used does not depend on the size of the book, unless the book
+        has changes not yet saved. The filters are evaluated in SQL.
+
+        Args:
+            chunksize (int): the maximum number of splits in each DataFrame
+            start (:class:`datetime.date` or :class:`datetime.datetime`): only splits posted on or after start
+            end (:class:`datetime.date` or :class:`datetime.datetime`): only splits posted on or before end
+            account (:class:`piecash.core.account.Account`): only splits of the account or of its sub-accounts
+            additional_fields (list of str): additional fields to extract (see :meth:`splits_df`)
+
+        Returns:
+            iterator of :class:`pandas.DataFrame`
+        """
+        try:
+            import pandas
+        except ImportError:
+            raise GnucashException("pandas is required to output dataframes")
+
+        fields = _splits_df_fields + (additional_fields if additional_fields else [])
+
+        query, row_getters = self._splits_select(fields, start=start, end=end, account=account)
+        fullnames = _account_fullnames(self.session)
+
+        for rows in self._iter_rows(query, chunksize):
+            df_splits = pandas.DataFrame(_splits_rows(self.session, rows, row_getters, fullnames),
+                                         columns=fields)
+            yield df_splits.set_index("guid")
+
     def prices_df(self):
         """
         Return a pandas DataFrame with all prices (:class:`piecash.core.commodity.Price`) from the book
@@ -530,3 +1364,88 @@ class Book(DeclarativeBaseGuid):
                                       for pr in prices], columns=fields)
 
         return df_prices
+
+    def iter_prices_df(self, chunksize=10000, start=None, end=None, commodity=None, currency=None):
+        """
+        Iterate on the prices (:class:`piecash.core.commodity.Price`) from the book as pandas DataFrames of at most
+        chunksize rows (with the same columns as :meth:`prices_df`), ordered by date.
+
+        The rows are streamed from the database (through a server-side cursor if the backend supports it, on a
+        dedicated connection) so that the memory used does not depend on the number of prices, unless the book
+        has changes not yet saved. The filters are evaluated in SQL.
+
+        Args:
+            chunksize (int): the maximum number of prices in each DataFrame
+            start (:class:`datetime.date` or :class:`datetime.datetime`): only prices on or after start
+            end (:class:`datetime.date` or :class:`datetime.datetime`): only prices on or before end
+            commodity (:class:`piecash.core.commodity.Commodity`): only prices of the commodity
+            currency (:class:`piecash.core.commodity.Commodity`): only prices expressed in the currency
+
+        Returns:
+            iterator of :class:`pandas.DataFrame`
+        """
+        try:
+            import pandas
+        except ImportError:
+            raise GnucashException("pandas is required to output dataframes")
+
+        flush_pending_changes(self.session)
+
+        Currency = aliased(Commodity)
+        fields = ["date", "type", "value",
+                  "commodity.guid", "commodity.mnemonic",
+                  "currency.guid", "currency.mnemonic", ]
+        query = select([Price.date, Price.type, Price._value_num, Price._value_denom,
+                        Commodity.guid, Commodity.mnemonic,
+                        Currency.guid, Currency.mnemonic]) \
+            .select_from(join(Price, Commodity, Price.commodity).join(Currency, Price.currency)) \
+            .order_by(Price.date, Commodity.mnemonic, Currency.mnemonic)
+
+        for clause in datetime_range_clauses(self.session, Price.date, start, end):
+            query = query.where(clause)
+        if commodity is not None:
+            query = query.where(Price.commodity_guid == commodity.guid)
+        if currency is not None:
+            query = query.where(Price.currency_guid == currency.guid)
+
+        for rows in self._iter_rows(query, chunksize):
+            yield pandas.DataFrame([[row[0], row[1], Decimal(row[2]) / row[3]] + list(row[4:])
+                                    for row in rows], columns=fields)
+
+
+class BulkTransactions(object):
+    """Buffer of transactions inserted by batches with :meth:`Book.bulk_insert_transactions`
+    (see :meth:`Book.bulk_transactions`).
+
+    The transactions still in the buffer are inserted when leaving the context manager (except in case of exception).
+
+    Attributes:
+        guids (list of str): the guids of the transactions already inserted
+    """
+
+    def __init__(self, book, batch_size=10000):
+        self.book = book
+        self.batch_size = batch_size
+        self.rows = []
+        self.guids = []
+
+    def add(self, row):
+        """Add a transaction (see :meth:`Book.bulk_insert_transactions` for the format of the row)"""
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Insert the transactions in the buffer"""
+        rows, self.rows = self.rows, []
+        if rows:
+            self.guids.extend(self.book.bulk_insert_transactions(rows))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.flush()
+        else:
+            self.rows = []
@@ -2,17 +2,18 @@ from __future__ import division
 from __future__ import unicode_literals
 
 import datetime
+from bisect import bisect_left, bisect_right
 from decimal import Decimal
 
 import yahoo_finance
-from sqlalchemy import Column, VARCHAR, INTEGER, ForeignKey, BIGINT, Index
-from sqlalchemy.orm import relation
+from sqlalchemy import Column, VARCHAR, INTEGER, ForeignKey, BIGINT, Index, select
+from sqlalchemy.orm import relation, object_session
 
 from ._commodity_helper import quandl_fx
 from .._common import CallableList
 from .._common import GnucashException, hybrid_property_gncnumeric
 from .._declbase import DeclarativeBaseGuid
-from ..sa_extra import _DateTime
+from ..sa_extra import _DateTime, tz, flush_pending_changes
 
 
 class GncCommodityError(GnucashException):
@@ -81,6 +82,132 @@ class Price(DeclarativeBaseGuid):
                                                        self.commodity.mnemonic)
 
 
+class PriceIndex(object):
+    """
+    In memory index of the prices of a session used by :meth:`Commodity.price_at`.
+
+    For each (commodity, currency), the dates and values of the prices are loaded once (with a single query)
+    in lists sorted by date so that a lookup is a bisection. The index of a (commodity, currency) is dropped
+    whenever a price of this (commodity, currency) is flushed (and the whole index when the session is rolled back).
+
+    It also indexes the Price objects of a given (type, source) by (commodity, currency, date) for the
+    :meth:`piecash.core.transaction.Split.validate` upserts. This hash index is loaded once (with a single query) and
+    is maintained on each flush.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self._series = {}
+        self._prices = {}
+        self._price_keys = {}
+
+    @staticmethod
+    def of(session):
+        """Return the PriceIndex of the session (creating it if needed)"""
+        index = getattr(session, "_price_index", None)
+        if index is None:
+            index = session._price_index = PriceIndex(session)
+        return index
+
+    def series(self, commodity_guid, currency_guid):
+        """Return the sorted lists of dates and values of the prices of the commodity in the currency"""
+        key = (commodity_guid, currency_guid)
+        series = self._series.get(key)
+        if series is None:
+            dates, values = [], []
+            for date, num, denom in self.session.execute(
+                    select([Price.date, Price._value_num, Price._value_denom])
+                            .where(Price.commodity_guid == commodity_guid)
+                            .where(Price.currency_guid == currency_guid)
+                            .order_by(Price.date)):
+                dates.append(date)
+                values.append(Decimal(num) / denom)
+            series = self._series[key] = (dates, values)
+        return series
+
+    def invalidate(self, commodity_guid=None, currency_guid=None):
+        """Drop the prices of the (commodity, currency) from the index (or all prices if not specified)"""
+        if commodity_guid is None and currency_guid is None:
+            self._series.clear()
+            self._prices.clear()
+            self._price_keys.clear()
+        else:
+            self._series.pop((commodity_guid, currency_guid), None)
+
+    @staticmethod
+    def _key_date(date):
+        # dates not yet reloaded from the database may still be naive
+        return tz.localize(date) if date.tzinfo is None else date
+
+    @staticmethod
+    def _key(price):
+        # use the foreign keys if available to avoid loading the commodities of each price
+        return (price.commodity_guid or price.commodity.guid,
+                price.currency_guid or price.currency.guid,
+                PriceIndex._key_date(price.date))
+
+    def _prices_of(self, type, source):
+        prices = self._prices.get((type, source))
+        if prices is None:
+            prices = self._prices[type, source] = {}
+            for price in self.session.query(Price).filter_by(type=type, source=source):
+                key = self._key(price)
+                if key not in prices:
+                    prices[key] = price
+                    self._price_keys[price] = (type, source), key
+        return prices
+
+    def get(self, commodity, currency, date, type, source):
+        """Return the price of the commodity in the currency at the date with the given type and source
+        (or None if there is no such price)"""
+        return self._prices_of(type, source).get((commodity.guid, currency.guid, self._key_date(date)))
+
+    def add(self, price):
+        """Add a (new) price to the hash index"""
+        self.discard(price)
+        prices = self._prices.get((price.type, price.source))
+        if prices is not None:
+            key = self._key(price)
+            if key not in prices:
+                prices[key] = price
+                self._price_keys[price] = (price.type, price.source), key
+
+    def discard(self, price):
+        """Remove a price from the hash index"""
+        group_key = self._price_keys.pop(price, None)
+        if group_key is not None:
+            group, key = group_key
+            self._prices[group].pop(key, None)
+
+    @staticmethod
+    def after_flush(session, flush_context):
+        """Drop from the index the (commodity, currency) of the prices that have been flushed
+        and maintain the hash index of the prices"""
+        index = getattr(session, "_price_index", None)
+        if index is None:
+            return
+        for obj in session.deleted:
+            if isinstance(obj, Price):
+                index.invalidate(obj.commodity_guid, obj.currency_guid)
+                index.discard(obj)
+        for obj in session.dirty:
+            if isinstance(obj, Price):
+                # the (commodity, currency) of the price may have changed
+                index._series.clear()
+                index.add(obj)
+        for obj in session.new:
+            if isinstance(obj, Price):
+                index.invalidate(obj.commodity_guid, obj.currency_guid)
+                index.add(obj)
+
+    @staticmethod
+    def after_rollback(session):
+        """Drop the index as the prices flushed may have been rolled back"""
+        index = getattr(session, "_price_index", None)
+        if index is not None:
+            index.invalidate()
+
+
 class Commodity(DeclarativeBaseGuid):
     """
     A GnuCash Commodity.
@@ -189,6 +316,64 @@ class Commodity(DeclarativeBaseGuid):
     def __unirepr__(self):
         return u"Commodity<{}:{}>".format(self.namespace, self.mnemonic)
 
+    def price_at(self, date=None, currency=None, method="last"):
+        """
+        Return the price of the commodity at a given date from the prices available in the book.
+
+        The prices of the (commodity, currency) are loaded once per session in a sorted index
+        (see :class:`PriceIndex`) so that each lookup is a bisection on the dates.
+
+        Args:
+            date (:class:`datetime.date` or :class:`datetime.datetime`): the date of the price (None for the last price)
+            currency (:class:`Commodity`): the currency in which the price is expressed (by default, the base_currency
+                of the commodity)
+            method (str): "last" for the last price on or before the date, "next" for the first price on or after the
+                date, "nearest" for the price the closest to the date
+
+        Returns:
+            :class:`decimal.Decimal`: the value of the price
+
+        Raises:
+            GncPriceError: if no price is found
+        """
+        session = object_session(self)
+        if session is None:
+            raise GncPriceError("Cannot retrieve a price for a commodity not attached to a book")
+        if method not in ("last", "next", "nearest"):
+            raise ValueError("Unknown method '{}' (should be one of 'last', 'next' or 'nearest')".format(method))
+
+        if currency is None:
+            currency = self.base_currency
+
+        flush_pending_changes(session)
+
+        dates, values = PriceIndex.of(session).series(self.guid, currency.guid)
+
+        if date is None:
+            i_last, i_next = len(dates) - 1, None
+        else:
+            if not isinstance(date, datetime.datetime):
+                date = datetime.datetime.combine(date, datetime.time.max if method == "last" else datetime.time.min)
+            if date.tzinfo is None:
+                date = tz.localize(date)
+            i_last = bisect_right(dates, date) - 1
+            i_next = bisect_left(dates, date)
+            i_next = i_next if i_next < len(dates) else None
+
+        i_last = i_last if i_last >= 0 else None
+        if method == "last":
+            i = i_last
+        elif method == "next":
+            i = i_next
+        elif i_last is None or i_next is None:
+            i = i_next if i_last is None else i_last
+        else:
+            i = i_last if (date - dates[i_last]) <= (dates[i_next] - date) else i_next
+
+        if i is None:
+            raise GncPriceError("No price available for {} in {} ({} {})".format(self, currency, method, date))
+        return values[i]
+
     def update_prices(self, start_date=None):
         """
         Retrieve online prices for the commodity:
@@ -10,8 +10,10 @@ from sqlalchemy.sql.ddl import DropConstraint, DropIndex
 from sqlalchemy_utils import database_exists
 
 from .book import Book
+from .account import AccountIndex
+from .commodity import PriceIndex
 from .._common import GnucashException
-from ..sa_extra import create_piecash_engine, DeclarativeBase, Session
+from ..sa_extra import create_piecash_engine, get_piecash_engine, dispose_piecash_engines, DeclarativeBase, Session
 
 version_supported = {
     '2.6': {
@@ -187,6 +189,9 @@ def create_book(sqlite_file=None,
 
     uri_conn = build_uri(sqlite_file, uri_conn, db_type, db_user, db_password, db_name, db_host, db_port)
 
+    # the engines shared by open_book may have checked a previous database with the same uri
+    dispose_piecash_engines(uri_conn)
+
     _db_created = False
 
     # create database (if DB is not a sqlite in memory)
@@ -278,6 +283,9 @@ def open_book(sqlite_file=None,
               db_name=None,
               db_host=None,
               db_port=None,
+              preload=None,
+              reuse_engine=False,
+              sqlite_profile="default",
               **kwargs):
     """Open an existing GnuCash book
 
@@ -291,6 +299,14 @@ def open_book(sqlite_file=None,
          the existing lock is in error and no other client actually has the file locked!!!)
     :param bool do_backup: do a backup if the file written in RW (i.e. readonly=False)
         (this only works with the sqlite backend and copy the file with .{:%Y%m%d%H%M%S}.gnucash appended to it)
+    :param str preload: the name of a preload profile to load the objects of the book when opening it
+        (see :meth:`piecash.core.book.Book.preload`)
+    :param bool reuse_engine: reuse the engine (and its pool of connections) of a previous call with the same
+        uri and engine options (the check of the existence of the database and of the versions of the tables are
+        only done the first time), see :func:`piecash.sa_extra.get_piecash_engine`
+    :param str sqlite_profile: the profile used to tune the sqlite connections ("default", "readonly-fast" to read
+        large books with the file opened in read only mode or "bulk-write" to write many objects),
+        see :func:`piecash.sa_extra.create_piecash_engine`
 
     :return: the document as a gnucash session
     :rtype: :class:`GncSession`
@@ -303,12 +319,21 @@ def open_book(sqlite_file=None,
     if uri_conn == "sqlite:///:memory:":
         raise ValueError("An in memory sqlite gnucash databook cannot be opened, it should be created")
 
+    if sqlite_profile == "readonly-fast" and not readonly:
+        raise ValueError("The sqlite profile 'readonly-fast' can only be used with readonly=True")
+    kwargs["sqlite_profile"] = sqlite_profile
+
+    engine = get_piecash_engine(uri_conn, **kwargs) if reuse_engine else None
+    # the checks of the database are only done once for an engine of the registry
+    checked = getattr(engine, "_piecash_checked", False)
+
     # create database (if not sqlite in memory)
-    if not database_exists(uri_conn):
+    if not checked and not database_exists(uri_conn):
         raise GnucashException("Database '{}' does not exist (please use create_book to create " \
                                "GnuCash books from scratch)".format(uri_conn))
 
-    engine = create_piecash_engine(uri_conn, **kwargs)
+    if engine is None:
+        engine = create_piecash_engine(uri_conn, **kwargs)
 
     # backup database if readonly=False and do_backup=True
     if not readonly and do_backup:
@@ -322,22 +347,26 @@ def open_book(sqlite_file=None,
 
         shutil.copyfile(url, url_backup)
 
-    locks = list(engine.execute(gnclock.select()))
+    s = Session(bind=engine)
+
+    locks = list(s.execute(gnclock.select()))
 
     # ensure the file is not locked by GnuCash itself
     if locks and not open_if_lock:
+        s.close()
         raise GnucashException("Lock on the file")
 
-    s = Session(bind=engine)
-
-    # check the versions in the table versions is consistent with the API
-    version_book = {v.table_name: v.table_version
-                    for v in s.query(Version).all()
-                    if "Gnucash" not in v.table_name}
-    assert any(version_book == {k: v
-                                for k, v in vt.items() if
-                                "Gnucash" not in k}
-               for version, vt in version_supported.items()), "Unsupported table versions"
+    if not checked:
+        # check the versions in the table versions is consistent with the API
+        version_book = {v.table_name: v.table_version
+                        for v in s.query(Version).all()
+                        if "Gnucash" not in v.table_name}
+        assert any(version_book == {k: v
+                                    for k, v in vt.items() if
+                                    "Gnucash" not in k}
+                   for version, vt in version_supported.items()), "Unsupported table versions"
+        if reuse_engine:
+            engine._piecash_checked = True
 
     book = s.query(Book).one()
     adapt_session(s, book=book, readonly=readonly)
@@ -355,6 +384,10 @@ def open_book(sqlite_file=None,
             # write to the DB, but we assume the user knows what they are doing if they get here.
             pass
 
+    if preload:
+        # keep a reference to the preloaded objects (the session only keeps weak references)
+        book._preloaded = book.preload(preload)
+
     return book
 
 
@@ -422,3 +455,8 @@ def adapt_session(session, book, readonly):
 
 event.listen(Session, 'before_commit', Book.validate_book)
 event.listen(Session, 'before_flush', Book.track_dirty)
+event.listen(Session, 'after_flush', PriceIndex.after_flush)
+event.listen(Session, 'after_rollback', PriceIndex.after_rollback)
+event.listen(Session, 'after_flush', AccountIndex.after_flush)
+event.listen(Session, 'before_attach', AccountIndex.before_attach)
+event.listen(Session, 'after_rollback', AccountIndex.after_rollback)
@@ -146,25 +146,26 @@ class Split(DeclarativeBaseGuid):
 
         if self.transaction.currency != self.account.commodity:
             # let us also add a Price
-            # TODO: check if price already exist at that tme
-            from piecash import Price
+            from .commodity import Price, PriceIndex
 
             value = (self.value / self.quantity).quantize(Decimal("0.000001"))
-            try:
-                # find existing price if any
-                pr = self.book.prices(commodity=self.account.commodity,
-                                      currency=self.transaction.currency,
-                                      date=self.transaction.post_date,
-                                      type="transaction",
-                                      source="user:split-register")
+            # find existing price if any (through the hash index of the prices of the session)
+            price_index = PriceIndex.of(self.book.session)
+            pr = price_index.get(commodity=self.account.commodity,
+                                 currency=self.transaction.currency,
+                                 date=self.transaction.post_date,
+                                 type="transaction",
+                                 source="user:split-register")
+            if pr is not None:
                 pr.value = value
-            except KeyError:
+            else:
                 pr = Price(commodity=self.account.commodity,
                            currency=self.transaction.currency,
                            date=self.transaction.post_date,
                            value=value,
                            type="transaction",
                            source="user:split-register")
+                price_index.add(pr)
 
             # and an action if not yet defined
             if self.action == "":
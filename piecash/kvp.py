@@ -2,15 +2,21 @@ import datetime
 import decimal
 import sys
 import uuid
+from collections import defaultdict
 from enum import Enum
 from importlib import import_module
 
-from sqlalchemy import Column, VARCHAR, INTEGER, REAL, BIGINT, types, event
-from sqlalchemy.orm import relation, foreign, object_session, backref
+from sqlalchemy import Column, VARCHAR, INTEGER, REAL, BIGINT, types, event, select, and_, inspect, \
+    Table, MetaData, Index
+from sqlalchemy.orm import relation, foreign, object_session, backref, mapper, aliased
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm import exc as orm_exc
+from sqlalchemy.orm.base import instance_state
+from sqlalchemy.orm.util import identity_key
 
 from ._common import CallableList
-from ._common import hybrid_property_gncnumeric
-from .sa_extra import _DateTime, DeclarativeBase, _Date
+from ._common import hybrid_property_gncnumeric, to_decimal, decimal_to_gncnumeric
+from .sa_extra import _DateTime, DeclarativeBase, _Date, in_batches
 
 if sys.version > '3':
     str_unicode = str
@@ -68,23 +74,44 @@ class SlotType(types.TypeDecorator):
             return KVP_Type(value)
 
 
+def _slots_by_name(slots):
+    """Return the index name -> slot of a collection of slots (built on first use and then kept in sync
+    through the append/remove events of the slots relationships)"""
+    index = getattr(slots, "_slots_by_name", None)
+    if index is None:
+        index = {}
+        for sl in slots:
+            # keep the first slot if there are duplicates (as a linear scan would do)
+            index.setdefault(sl.name, sl)
+        slots._slots_by_name = index
+    return index
+
+
+def index_slot_appended(target, value, initiator):
+    """Add the slot to the name index of the slots collection of target (if the index exists)"""
+    index = getattr(instance_state(target).dict.get("slots"), "_slots_by_name", None)
+    if index is not None:
+        index.setdefault(value.name, value)
+
+
+def index_slot_removed(target, value, initiator):
+    """Drop the name index of the slots collection of target (it is rebuilt on next use)"""
+    slots = instance_state(target).dict.get("slots")
+    if slots is not None:
+        slots._slots_by_name = None
+
+
 class DictWrapper(object):
     def __contains__(self, key):
-        for sl in self.slots:
-            if sl.name == key:
-                return True
-        else:
-            return False
+        return key in _slots_by_name(self.slots)
 
     def __getitem__(self, key):
         assert not isinstance(key, int), \
             "You are accessing slots with an integer (={}) while a string is expected".format(key)
         keys = key.split("/", 1)
         key = keys[0]
-        for sl in self.slots:
-            if sl.name == key:
-                break
-        else:
+        sl = _slots_by_name(self.slots).get(key)
+        if sl is None:
             raise KeyError("No slot exists with name '{}'".format(key))
         if len(keys) > 1:
             return sl[keys[1]]
@@ -94,10 +121,8 @@ class DictWrapper(object):
     def __setitem__(self, key, value):
         keys = key.split("/", 1)
         key = keys[0]
-        for sl in self.slots:
-            if sl.name == key:
-                break
-        else:
+        sl = _slots_by_name(self.slots).get(key)
+        if sl is None:
             # new key
             if len(keys) > 1:
                 if isinstance(self, SlotFrame):
@@ -125,15 +150,16 @@ class DictWrapper(object):
             del self.slots[key]
             return
         keys = key.split("/", 1)
-        for i, sl in enumerate(self.slots):
-            if sl.name == keys[0]:
-                break
-        else:
+        sl = _slots_by_name(self.slots).get(keys[0])
+        if sl is None:
             raise KeyError("No slot exists with name '{}'".format(key))
         if len(keys) > 1:
             del sl[keys[1]]
         else:
-            del self.slots[i]
+            for i, sl_i in enumerate(self.slots):
+                if sl_i is sl:
+                    del self.slots[i]
+                    break
 
     def iteritems(self):
         for sl in self.slots:
@@ -171,6 +197,8 @@ class Slot(DeclarativeBase):
 
     __mapper_args__ = {
         'polymorphic_on': slot_type,
+        # load the value columns of all slot types with the slots (instead of one query per slot and per column)
+        'with_polymorphic': '*',
     }
 
     def __init__(self, name, value=None):
@@ -266,12 +294,14 @@ class SlotFrame(DictWrapper, Slot):
 
     @property
     def value(self):
+        if can_load_slot_tree(self):
+            load_slot_tree(self)
         # convert to dict
         return {sl.name: sl.value for sl in self.slots}
 
     @value.setter
     def value(self, value):
-        self.slots = [slot(parent=self, name=k, value=v) for k, v in value.items()]
+        self.slots = slots_from_dict(self, value)
 
     def __init__(self, **kwargs):
         self.guid_val = uuid.uuid4().hex
@@ -286,6 +316,8 @@ class SlotList(SlotFrame):
 
     @property
     def value(self):
+        if can_load_slot_tree(self):
+            load_slot_tree(self)
         # convert to dict
         return [sl.value for sl in self.slots]
 
@@ -307,6 +339,10 @@ def remove_slot(target, value, initiator):
         s.delete(value)
 
 
+event.listen(SlotFrame.slots, 'append', index_slot_appended, propagate=True)
+event.listen(SlotFrame.slots, 'remove', index_slot_removed, propagate=True)
+
+
 class SlotGUID(SlotFrame):
     __mapper_args__ = {
         'polymorphic_identity': KVP_Type.KVP_TYPE_GUID
@@ -324,32 +360,208 @@ class SlotGUID(SlotFrame):
         'default-currency': 'piecash.core.commodity.Commodity',
     }
 
+    # cache of the classes resolved from _mapping_name_class
+    _classes = {}
+
+    # target object cached by value or by resolve_guid_slots as (guid, object)
+    _target = None
+
     @property
     def Class(self):
-        name, guid = self.name, self.guid_val
+        return self._class_of_name(self.name)
+
+    @classmethod
+    def _class_of_name(cls, name):
         if name.startswith('CURRENCY::'):
             # handle capital gain account
             class_to_retrieve = 'piecash.core.account.Account'
         else:
-            class_to_retrieve = self._mapping_name_class.get(name, None)
+            class_to_retrieve = cls._mapping_name_class.get(name, None)
             if class_to_retrieve is None:
                 raise ValueError(
                     "Smart retrieval of GUID slot with name '{}' is not yet supported. "
                     "Need to retrieve proper object type in kvp module "
                     "(add in SlotGUID._mapping_name_class)".format(name))
-        class_module, class_name = class_to_retrieve.rsplit('.', 1)
-        mod = import_module(class_module)
-        Class = getattr(mod, class_name)
+        Class = cls._classes.get(class_to_retrieve)
+        if Class is None:
+            class_module, class_name = class_to_retrieve.rsplit('.', 1)
+            mod = import_module(class_module)
+            Class = cls._classes[class_to_retrieve] = getattr(mod, class_name)
         return Class
 
     @property
     def value(self):
-        return object_session(self).query(self.Class).filter_by(guid=self.guid_val).one()
+        session = object_session(self)
+        if self._target is not None:
+            guid, obj = self._target
+            if guid == self.guid_val and object_session(obj) is session:
+                return obj
+        # query.get looks first in the identity map
+        obj = session.query(self.Class).get(self.guid_val)
+        if obj is None:
+            raise orm_exc.NoResultFound("No {} found with guid '{}'".format(self.Class.__name__, self.guid_val))
+        self._target = self.guid_val, obj
+        return obj
 
     @value.setter
     def value(self, value):
         assert isinstance(value, self.Class)
         self.guid_val = value.guid
+        self._target = value.guid, value
+
+
+def resolve_guid_slots(session, slots):
+    """
+    Load the objects referred to by the GUID slots with one query per class of object
+    (after looking in the identity map of the session) and cache them on the slots.
+
+    The slots that are not GUID slots (or with a name not supported by SlotGUID) are ignored.
+
+    :param session: the sqlalchemy session of the slots
+    :param slots: the slots to resolve
+    :return: the list of the objects found (missing objects are ignored and will raise at access)
+    """
+    to_load = defaultdict(lambda: defaultdict(list))
+    found = []
+    for sl in slots:
+        if not isinstance(sl, SlotGUID) or sl.guid_val is None:
+            continue
+        try:
+            Class = sl.Class
+        except ValueError:
+            continue
+        obj = session.identity_map.get(identity_key(Class, sl.guid_val))
+        if obj is None:
+            to_load[Class][sl.guid_val].append(sl)
+        else:
+            sl._target = sl.guid_val, obj
+            found.append(obj)
+
+    for Class, slots_of_guid in to_load.items():
+        guids = list(slots_of_guid)
+        for batch in in_batches(guids):
+            for obj in session.query(Class).filter(Class.guid.in_(batch)):
+                for sl in slots_of_guid[obj.guid]:
+                    sl._target = obj.guid, obj
+                found.append(obj)
+
+    return found
+
+
+def can_load_slot_tree(frame):
+    """Return True if the slots of the frame can be loaded with :func:`load_slot_tree`, i.e. if
+    the slots of the frame are not loaded yet and if the database supports recursive common table expressions"""
+    state = instance_state(frame)
+    if "slots" in state.dict or not state.has_identity:
+        return False
+    session = object_session(frame)
+    if session is None:
+        return False
+    dialect = session.get_bind().dialect
+    if dialect.name == "sqlite":
+        return dialect.dbapi.sqlite_version_info >= (3, 8, 3)
+    if dialect.name == "mysql":
+        return (dialect.server_version_info or ()) >= (8,)
+    return True
+
+
+def load_slot_tree(frame):
+    """
+    Load the slots of a frame and of all its nested frames with a single recursive query and populate
+    their (not yet loaded) slots collections, as :func:`preload_slots` does with one query per level of nesting.
+
+    The objects referred to by the GUID slots are loaded with one query per class.
+
+    :param frame: the SlotFrame (or SlotList)
+    :return: the frame
+    """
+    session = object_session(frame)
+    slots = Slot.__table__
+    frame_types = [KVP_Type.KVP_TYPE_FRAME, KVP_Type.KVP_TYPE_GLIST]
+
+    tree = select([slots]).where(slots.c.obj_guid == frame.guid_val).cte("slot_tree", recursive=True)
+    tree = tree.union_all(select([slots]).where(and_(slots.c.obj_guid == tree.c.guid_val,
+                                                     tree.c.slot_type.in_(frame_types))))
+    children = defaultdict(list)
+    tree_slot = aliased(Slot, tree)
+    tree_slots = session.query(tree_slot).order_by(tree_slot.id).all()
+    for sl in tree_slots:
+        children[sl.obj_guid].append(sl)
+
+    # populate the collections of the frames from the top of the tree (as long as they are not loaded)
+    owners = [frame]
+    while owners:
+        frames = []
+        for owner in owners:
+            set_committed_value(owner, "slots", children[owner.guid_val])
+            for sl in children[owner.guid_val]:
+                set_committed_value(sl, "parent", owner)
+                if isinstance(sl, SlotFrame) and not isinstance(sl, SlotGUID) \
+                        and "slots" not in instance_state(sl).dict:
+                    frames.append(sl)
+        owners = frames
+
+    resolve_guid_slots(session, tree_slots)
+
+    return frame
+
+
+def slot_value_clause(slots, value):
+    """Return the SQL clause testing that the slot in the (aliased) slots table has the given value
+
+    :param slots: the slots table (or an alias of it)
+    :param value: the value of the slot (a simple value or an object for GUID slots)
+    :raise ValueError: if the value is a dict or a list
+    """
+    cls = _slot_class(value)
+    if cls in (SlotFrame, SlotList):
+        raise ValueError("Cannot query slots on a value of type '{}'".format(type(value).__name__))
+    if cls is SlotGUID:
+        return and_(slots.c.slot_type == KVP_Type.KVP_TYPE_GUID,
+                    slots.c.guid_val == value.guid)
+    slot_type = cls.__mapper_args__["polymorphic_identity"]
+    if cls is SlotNumeric:
+        # compare the fractions num/denom exactly
+        num, denom = decimal_to_gncnumeric(to_decimal(value))
+        return and_(slots.c.slot_type == slot_type,
+                    slots.c.numeric_val_num * denom == slots.c.numeric_val_denom * num)
+    return and_(slots.c.slot_type == slot_type,
+                slots.c[KVPtype_fields[slot_type]] == value)
+
+
+# helper index on slots(name, obj_guid) to query objects by slot (see create_slots_index)
+_slots_index_table = Table("slots", MetaData(),
+                           Column("obj_guid", VARCHAR(length=32)),
+                           Column("name", VARCHAR(length=4096)))
+slots_name_index = Index("slots_name_obj_guid_index",
+                         _slots_index_table.c.name, _slots_index_table.c.obj_guid,
+                         mysql_length={"name": 255})
+
+
+def create_slots_index(connection):
+    """Create (if it does not exist yet) the index on slots(name, obj_guid) used to query objects by slots.
+
+    GnuCash ignores this additional index (it can be dropped at any time with :func:`drop_slots_index`).
+
+    :param connection: the sqlalchemy connection (or engine) to the book
+    :return: True if the index has been created
+    """
+    if any(idx["name"] == slots_name_index.name for idx in inspect(connection).get_indexes("slots")):
+        return False
+    slots_name_index.create(bind=connection)
+    return True
+
+
+def drop_slots_index(connection):
+    """Drop (if it exists) the index created by :func:`create_slots_index`
+
+    :param connection: the sqlalchemy connection (or engine) to the book
+    :return: True if the index has been dropped
+    """
+    if not any(idx["name"] == slots_name_index.name for idx in inspect(connection).get_indexes("slots")):
+        return False
+    slots_name_index.drop(bind=connection)
+    return True
 
 
 def get_all_subclasses(cls):
@@ -365,35 +577,127 @@ def get_all_subclasses(cls):
     return all_subclasses
 
 
+# slot class to use for each python type (see _slot_class)
+_slot_classes = None
+# python types handled by each slot class in the order of get_all_subclasses (first match wins)
+_slot_types = None
+
+
+def build_slot_dispatch(*args):
+    """Build the dispatch table python type -> slot class used by :func:`slot`
+    (called once after the configuration of the mappers)"""
+    global _slot_classes, _slot_types
+
+    # handle datetime before others (as otherwise can be mixed with date)
+    _slot_types = [((datetime.datetime,), SlotTime)]
+    _slot_types.extend((cls._python_type, cls)
+                       for cls in get_all_subclasses(Slot)
+                       if cls not in (SlotFrame, SlotList))
+    _slot_classes = {dict: SlotFrame, list: SlotList}
+    for pytypes, cls in _slot_types:
+        for pytype in pytypes:
+            _slot_classes.setdefault(pytype, cls)
+
+
+event.listen(mapper, "after_configured", build_slot_dispatch)
+
+
+def _slot_class(value):
+    """Return the slot class to use for the value (exact type first, then isinstance in the original order)"""
+    if _slot_classes is None:
+        build_slot_dispatch()
+    pytype = type(value)
+    cls = _slot_classes.get(pytype)
+    if cls is None:
+        for pytypes, cls in _slot_types:
+            if isinstance(value, pytypes):
+                break
+        else:
+            if isinstance(value, dict):
+                cls = SlotFrame
+            elif isinstance(value, list):
+                cls = SlotList
+            else:
+                raise ValueError("Cannot handle type of '{}'".format(value))
+        _slot_classes[pytype] = cls
+    return cls
+
+
+def slots_from_dict(parent, values):
+    """Return the slots (for the object or frame parent) representing the items of the dict values
+    (nested dicts/lists are converted to frames/lists of slots)
+
+    :param parent: the object or frame to which the slots will be attached
+    :param values: dict of name -> value
+    :return: list of slots
+    """
+    return [slot(parent=parent, name=k, value=v) for k, v in values.items()]
+
+
 def slot(parent, name, value):
     if isinstance(parent, SlotFrame):
         name = parent._name + "/" + name
 
-    # handle datetime before others (as otherwise can be mixed with date)
-    if isinstance(value, datetime.datetime):
-        return SlotTime(name=name, value=value)
-
-    for cls in get_all_subclasses(Slot):
-        if isinstance(value, cls._python_type) and cls != SlotFrame and cls != SlotList:
-            return cls(name=name, value=value)
+    cls = _slot_class(value)
 
-    if isinstance(value, dict):
+    if cls is SlotFrame:
         # transform a dict to Frame/Slots
         sf = SlotFrame(name=name)
-        for k, v in value.items():
-            sl = slot(parent=sf, name=k, value=v)
-            sl.parent = sf
+        sf.slots.extend(slots_from_dict(sf, value))
         return sf
 
-    if isinstance(value, list):
+    if cls is SlotList:
         # transform a list to List/Slots
         sf = SlotList(name=name)
-        for i, v in enumerate(value):
-            sl = slot(parent=sf, name=str(i), value=v)
-            sl.parent = sf
+        sf.slots.extend(slot(parent=sf, name=str(i), value=v) for i, v in enumerate(value))
         return sf
 
-    raise ValueError("Cannot handle type of '{}'".format(value))
+    return cls(name=name, value=value)
+
+
+def preload_slots(session, objects, resolve_guids=False):
+    """
+    Load the slots of the objects (including the slots of their frames) with one query per level of nesting
+    and populate their (not yet loaded) slots collections, instead of a lazy load per object and per frame.
+
+    :param session: the sqlalchemy session of the objects
+    :param objects: the objects (with slots) to preload
+    :param resolve_guids: True to also load the objects referred to by the GUID slots (see :func:`resolve_guid_slots`)
+    :return: the list of objects
+    """
+    objects = list(objects)
+
+    # objects or frames (keyed by the guid used in the obj_guid of their slots) whose slots are to load
+    owners = {obj.guid: obj for obj in objects
+              if "slots" not in instance_state(obj).dict}
+    guid_slots = []
+    while owners:
+        slots = defaultdict(list)
+        guids = list(owners)
+        for batch in in_batches(guids):
+            for sl in session.query(Slot) \
+                    .filter(Slot.obj_guid.in_(batch)) \
+                    .order_by(Slot.id):
+                slots[sl.obj_guid].append(sl)
+
+        frames = {}
+        for guid, owner in owners.items():
+            set_committed_value(owner, "slots", slots[guid])
+            for sl in slots[guid]:
+                if isinstance(owner, SlotFrame):
+                    set_committed_value(sl, "parent", owner)
+                # the slots of a SlotGUID are the ones of the object it refers to
+                if isinstance(sl, SlotFrame) and not isinstance(sl, SlotGUID) \
+                        and "slots" not in instance_state(sl).dict:
+                    frames[sl.guid_val] = sl
+            if resolve_guids:
+                guid_slots.extend(slots[guid])
+        owners = frames
+
+    if resolve_guids:
+        resolve_guid_slots(session, guid_slots)
+
+    return objects
 
 
 class SlotNumeric(Slot):
@@ -3,13 +3,17 @@ from __future__ import print_function
 
 import datetime
 import logging
+import os
+import sqlite3
 import sys
+import threading
 import unicodedata
 
 import pytz
 import tzlocal
-from sqlalchemy import types, Table, MetaData, ForeignKeyConstraint, event, create_engine
+from sqlalchemy import types, Table, MetaData, ForeignKeyConstraint, event, create_engine, func, type_coerce
 from sqlalchemy.dialects import sqlite
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.declarative import as_declarative
 from sqlalchemy.ext.hybrid import hybrid_property
@@ -20,8 +24,10 @@ from sqlalchemy.orm import exc as orm_exc
 
 if sys.version > '3':
     long = int
+    from urllib.request import pathname2url
 else:
     long = long
+    from urllib import pathname2url
 
 
 def __init__blocked(self, *args, **kwargs):
@@ -141,6 +147,73 @@ class _Date(types.TypeDecorator):
             return types.Date()
 
 
+def datetime_sort_key(session, col):
+    """Return the expression of a _DateTime column to compare/sort its values chronologically.
+
+    In sqlite, the datetimes are stored as strings in the format YYYYMMDDHHMMSS (GnuCash < 2.7 and piecash) or
+    YYYY-MM-DD HH:MM:SS (GnuCash >= 2.7), possibly both in the same column for a book edited by both,
+    so the column is normalized to YYYYMMDDHHMMSS. For the other backends, the column is returned unchanged."""
+    if session.get_bind().dialect.name != "sqlite":
+        return col
+    key = type_coerce(col, types.String)
+    for sep in ("-", " ", ":"):
+        key = func.replace(key, sep, "")
+    return key
+
+
+def _datetime_bound(session, d):
+    """Return the value to compare to the :func:`datetime_sort_key` of a _DateTime column for the datetime d
+    (for sqlite, the datetime converted to utc as done by _DateTime and formatted as YYYYMMDDHHMMSS)"""
+    if session.get_bind().dialect.name != "sqlite":
+        return d
+    if d.tzinfo is None:
+        d = tz.localize(d)
+    return d.astimezone(utc).strftime("%Y%m%d%H%M%S")
+
+
+def _start_of_day(d):
+    """Return the datetime d unchanged or the beginning of the day d if d is a date"""
+    if isinstance(d, datetime.datetime):
+        return d
+    return datetime.datetime.combine(d, datetime.time.min)
+
+
+def datetime_on_or_before(value, end):
+    """Return True if the datetime value is on or before end (the end of the day if end is a date), as the end bound
+    of :func:`datetime_range_clauses` but evaluated in python"""
+    if value.tzinfo is None:
+        value = tz.localize(value)
+    if isinstance(end, datetime.datetime):
+        return value <= (end if end.tzinfo is not None else tz.localize(end))
+    return value < tz.localize(datetime.datetime.combine(end + datetime.timedelta(days=1), datetime.time.min))
+
+
+def datetime_before_clause(session, col, before):
+    """Return the sql clause restricting a _DateTime column to the values strictly before the date/datetime before
+    (i.e. the complement of the start bound of :func:`datetime_range_clauses`)."""
+    return datetime_sort_key(session, col) < _datetime_bound(session, _start_of_day(before))
+
+
+def datetime_range_clauses(session, col, start=None, end=None):
+    """Return the list of sql clauses restricting a _DateTime column to the range [start, end].
+
+    If start (resp. end) is a date (and not a datetime), it is taken as the beginning (resp. the end) of the day.
+    A bound set to None is not restricted.
+    The column is compared through its :func:`datetime_sort_key` as sqlite compares the datetimes as strings.
+    """
+    key = datetime_sort_key(session, col)
+    clauses = []
+    if start is not None:
+        clauses.append(key >= _datetime_bound(session, _start_of_day(start)))
+    if end is not None:
+        if isinstance(end, datetime.datetime):
+            clauses.append(key <= _datetime_bound(session, end))
+        else:
+            next_day = datetime.datetime.combine(end + datetime.timedelta(days=1), datetime.time.min)
+            clauses.append(key < _datetime_bound(session, next_day))
+    return clauses
+
+
 def mapped_to_slot_property(col, slot_name, slot_transform=lambda x: x):
     """Assume the attribute in the class as the same name as the table column with "_" prepended"""
     col_name = "_{}".format(col.name)
@@ -249,30 +322,128 @@ def get_foreign_keys(metadata, engine):
 Session = sessionmaker(autoflush=True)
 
 
-def create_piecash_engine(uri_conn, **kwargs):
+def flush_pending_changes(session):
+    """Flush the pending changes of the session (if autoflush is enabled) so that they are taken into account by
+    the queries that do not go through the ORM (as done by the autoflush of ORM queries)"""
+    if session.autoflush:
+        session.flush()
+
+
+# number of parameters used in a single "IN (...)" clause (sqlite limits the number of parameters to 999)
+IN_BATCH_SIZE = 500
+
+
+def in_batches(values):
+    """Split the list of values in batches of IN_BATCH_SIZE values to stay below the limit of parameters
+    of some backends in "IN (...)" clauses"""
+    for i in range(0, len(values), IN_BATCH_SIZE):
+        yield values[i:i + IN_BATCH_SIZE]
+
+
+# PRAGMAs set on each new connection of a sqlite engine for each sqlite profile
+sqlite_profiles = {
+    "default": [],
+    "readonly-fast": [("mmap_size", 268435456), ("cache_size", -65536), ("temp_store", "MEMORY")],
+    "bulk-write": [("cache_size", -262144), ("temp_store", "MEMORY"), ("journal_mode", "TRUNCATE")],
+}
+
+
+def _sqlite_readonly_creator(path):
+    """Return a function opening the sqlite file in read only mode (with the immutable flag)"""
+    uri = "file:{}?mode=ro&immutable=1".format(pathname2url(os.path.abspath(path)))
+
+    def creator():
+        return sqlite3.connect(uri, uri=True)
+
+    return creator
+
+
+def create_piecash_engine(uri_conn, sqlite_profile="default", **kwargs):
+    """
+    Create the engine for the uri.
+
+    For sqlite, the sqlite_profile tunes the connections:
+
+    - "default": the sqlite defaults
+    - "readonly-fast": the file is opened in read only mode with the 'immutable' flag (the file must not be changed
+      by another process while it is opened), with memory mapped I/O, a large page cache and temporary tables
+      in memory
+    - "bulk-write": a very large page cache (to avoid spilling pages to the file in the middle of a transaction),
+      temporary tables in memory and a journal truncated instead of deleted at each commit. The synchronous setting
+      is kept to its default so that each commit (i.e. each save of the book) is synced to the file
+
+    :param str uri_conn: a sqlalchemy connection string
+    :param str sqlite_profile: the name of the sqlite profile (ignored for other databases)
+    :param kwargs: the options given to sqlalchemy.create_engine
+    :return: the engine
+    """
+    if sqlite_profile not in sqlite_profiles:
+        raise ValueError("Unknown sqlite profile '{}' (should be one of {})".format(
+            sqlite_profile, ", ".join(sorted(sqlite_profiles))))
+
+    url = make_url(uri_conn)
+    if (sqlite_profile == "readonly-fast" and url.drivername.startswith("sqlite") and url.database
+            and "creator" not in kwargs and sys.version_info >= (3, 4)):
+        kwargs["creator"] = _sqlite_readonly_creator(url.database)
+
     eng = create_engine(uri_conn, **kwargs)
 
     if eng.name == "sqlite":
-        # add proper isolation code for sqlite engine
+        pragmas = list(sqlite_profiles[sqlite_profile])
+        if sqlite_profile == "readonly-fast" and "creator" not in kwargs:
+            # sqlite3 does not support uri filenames (python 2)
+            pragmas.append(("query_only", 1))
+
         @event.listens_for(eng, "connect")
         def do_connect(dbapi_connection, connection_record):
-            # disable pysqlite's emitting of the BEGIN statement entirely.
-            # also stops it from emitting COMMIT before any DDL.
-            # print("=========================== in DO CONNECT")
-            # dbapi_connection.isolation_level = "IMMEDIATE"
-            # dbapi_connection.isolation_level = "EXCLUSIVE"
-            pass
-
-        @event.listens_for(eng, "begin")
-        def do_begin(conn):
-            # emit our own BEGIN
-            # print("=========================== in DO BEGIN")
-            # conn.execute("BEGIN EXCLUSIVE")
-            pass
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas:
+                cursor.execute("PRAGMA {}={}".format(name, value))
+            cursor.close()
+
+    return eng
+
 
+# engines shared by the books opened with open_book(..., reuse_engine=True) keyed by uri and engine options
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def _engine_key(uri_conn, kwargs):
+    return str(uri_conn), tuple(sorted((k, repr(v)) for k, v in kwargs.items()))
+
+
+def get_piecash_engine(uri_conn, **kwargs):
+    """
+    Return the engine for the uri and the engine options from the registry of the process (creating it with
+    :func:`create_piecash_engine` if needed) so that the books opened on the same database share
+    the engine (and its pool of connections, configured with the usual options as pool_size or pool_recycle).
+
+    :param str uri_conn: a sqlalchemy connection string
+    :param kwargs: the options given to sqlalchemy.create_engine
+    :return: the engine
+    """
+    key = _engine_key(uri_conn, kwargs)
+    with _engines_lock:
+        eng = _engines.get(key)
+        if eng is None:
+            eng = _engines[key] = create_piecash_engine(uri_conn, **kwargs)
     return eng
 
 
+def dispose_piecash_engines(uri_conn=None):
+    """
+    Dispose the engines of the registry of the process for the uri (or all the engines if uri_conn is None)
+    and remove them from the registry.
+
+    :param str uri_conn: a sqlalchemy connection string
+    """
+    with _engines_lock:
+        for key in list(_engines):
+            if uri_conn is None or key[0] == str(uri_conn):
+                _engines.pop(key).dispose()
+
+
 class ChoiceType(types.TypeDecorator):
     impl = types.INTEGER()
 
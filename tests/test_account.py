@@ -1,12 +1,18 @@
 # -*- coding: latin-1 -*-
+from datetime import date, datetime
+from decimal import Decimal
+
+import pandas
 import pytest
 
-from piecash import Account, Commodity
-from test_helper import db_sqlite_uri, db_sqlite, new_book, new_book_USD, book_uri
+from piecash import Account, Commodity, Transaction, Split
+from piecash._common import CallableList
+from piecash.core.account import AccountIndex
+from test_helper import db_sqlite_uri, db_sqlite, new_book, new_book_USD, book_uri, book_transactions, book_sample
 
 # dummy line to avoid removing unused symbols
 
-a = db_sqlite_uri, db_sqlite, new_book, new_book_USD, book_uri
+a = db_sqlite_uri, db_sqlite, new_book, new_book_USD, book_uri, book_transactions, book_sample
 
 
 class TestAccount_create_account(object):
@@ -156,3 +162,197 @@ class TestAccount_features(object):
         acc.commodity_scu = None
         assert acc.commodity_scu == EUR.fraction
         assert not acc.non_std_scu
+
+    def test_get_balance(self, book_transactions):
+        asset = book_transactions.accounts(name="asset")
+        broker = book_transactions.accounts(name="broker")
+        EUR = book_transactions.default_currency
+
+        assert asset.get_balance() == Decimal(715)
+        assert asset.get_balance(at_date=date(2015, 10, 25)) == Decimal(900)
+        assert book_transactions.accounts(name="inc").get_balance() == Decimal(1000)
+        assert str(book_transactions.accounts(name="inc").get_balance(at_date=date(2015, 10, 20))) == "0"
+        assert broker.get_balance() == Decimal(6)
+
+        # sub-accounts are converted with the last price available at the date
+        assert broker.get_balance(commodity=EUR) == Decimal("14.04")
+        assert asset.get_balance(recurse=True) == Decimal("729.04")
+        assert asset.get_balance(at_date=date(2015, 10, 30), recurse=True) == Decimal("684.999998")
+
+    def test_get_balance_sample(self, book_sample):
+        asset = book_sample.accounts(name="Asset")
+
+        assert asset.get_balance() == Decimal(1320)
+        assert asset.get_balance(at_date=date(2014, 12, 15)) == Decimal(500)
+        assert asset.get_balance(at_date=date(2014, 11, 15)) == Decimal(0)
+
+    def test_get_balance_detached(self, book_sample):
+        asset = book_sample.accounts(name="Asset")
+        # load the relationships used by get_balance before detaching the account from the book
+        asset.commodity, asset.children, [sp.transaction.post_date for sp in asset.splits]
+        book_sample.session.expunge(asset)
+
+        assert asset.get_balance(recurse=True) == Decimal(1320)
+        assert asset.get_balance(at_date=date(2014, 12, 15)) == Decimal(500)
+
+    def test_get_balance_mixed_dates(self, book_sample):
+        # piecash writes the dates as YYYYMMDDHHMMSS, also in a book written by GnuCash >= 2.7
+        asset = book_sample.accounts(name="Asset")
+        income = book_sample.accounts(name="Income")
+        Transaction(currency=book_sample.default_currency,
+                    description="mixed",
+                    post_date=datetime(2015, 1, 10),
+                    splits=[Split(account=asset, value=100),
+                            Split(account=income, value=-100)])
+
+        assert asset.get_balance(at_date=date(2015, 1, 5)) == Decimal(1320)
+        assert asset.get_balance(at_date=date(2015, 2, 1)) == Decimal(1420)
+        assert asset.get_balance(at_date=date(2014, 12, 15)) == Decimal(500)
+
+
+    def test_fullname_index(self, book_transactions):
+        broker = book_transactions.accounts(name="broker")
+        asset = book_transactions.accounts(name="asset")
+
+        assert broker.fullname == "asset:broker"
+        assert book_transactions.accounts(fullname="asset:broker") is broker
+        with pytest.raises(KeyError):
+            book_transactions.accounts(fullname="asset:foo")
+
+        # the index is dropped when an account is renamed or moved
+        asset.name = "assets"
+        assert broker.fullname == "assets:broker"
+        assert book_transactions.accounts(fullname="assets:broker") is broker
+        book_transactions.flush()
+        assert book_transactions.accounts(fullname="assets:broker") is broker
+
+        broker.parent = book_transactions.root_account
+        assert broker.fullname == "broker"
+        book_transactions.flush()
+        assert book_transactions.accounts(fullname="broker") is broker
+
+        # and when the changes are cancelled
+        book_transactions.cancel()
+        assert broker.fullname == "asset:broker"
+        assert book_transactions.accounts(fullname="asset:broker") is broker
+
+        # new accounts flag the index as stale (it is not used for lookups) until the next flush
+        index = AccountIndex.of(book_transactions.session)
+        acc = Account(name="new", type="ASSET", commodity=broker.commodity, parent=broker)
+        assert index._stale
+        assert index.fullname_of(broker) is None
+        assert acc.fullname == "asset:broker:new"
+        book_transactions.flush()
+        assert not index._stale
+        assert book_transactions.accounts(fullname="asset:broker:new") is acc
+        assert index.fullname_of(acc) == "asset:broker:new"
+
+        # accounts deleted in the session are not found
+        book_transactions.delete(acc)
+        with pytest.raises(KeyError):
+            book_transactions.accounts(fullname="asset:broker:new")
+
+    def test_subtree_index(self, book_transactions):
+        root = book_transactions.root_account
+        asset = book_transactions.accounts(name="asset")
+        broker = book_transactions.accounts(name="broker")
+        exp = book_transactions.accounts(name="exp")
+        index = AccountIndex.of(book_transactions.session)
+
+        assert index.subtree_guids(asset.guid) == [asset.guid, broker.guid]
+        assert index.subtree_guids(broker.guid) == [broker.guid]
+        assert set(index.subtree_guids(root.guid)) == {root.guid} | {acc.guid for acc in root.children} | {broker.guid}
+
+        # the numbering is refreshed when an account is moved
+        broker.parent = exp
+        book_transactions.flush()
+        assert index.subtree_guids(asset.guid) == [asset.guid]
+        assert index.subtree_guids(exp.guid) == [exp.guid, broker.guid]
+
+    def test_subtree_clause(self, book_transactions):
+        EUR = book_transactions.default_currency
+        asset = book_transactions.accounts(name="asset")
+        index = AccountIndex.of(book_transactions.session)
+
+        # more accounts in the subtree than the limit of parameters of sqlite
+        for i in range(1000):
+            Account(name="sub{}".format(i), type="ASSET", commodity=EUR, parent=asset)
+        book_transactions.flush()
+
+        clause = index.subtree_clause(Account.guid, asset.guid)
+        # the guids of the subtree are not passed as parameters
+        assert len(clause.compile().params) == 1
+        assert book_transactions.session.query(Account).filter(clause).count() == 1002
+        df = pandas.concat(book_transactions.iter_splits_df(account=asset))
+        assert len(df) == 6
+
+    def test_subtree_splits(self, book_transactions):
+        asset = book_transactions.accounts(name="asset")
+        broker = book_transactions.accounts(name="broker")
+
+        splits = asset.subtree_splits().all()
+        assert len(splits) == 6
+        assert {sp.account for sp in splits} == {asset, broker}
+        assert [sp.transaction.post_date for sp in splits] == sorted(sp.transaction.post_date for sp in splits)
+
+        splits = asset.subtree_splits(start=date(2015, 10, 25), end=date(2015, 10, 29)).all()
+        assert sorted(sp.value for sp in splits) == [Decimal(-200), Decimal(-100), Decimal(185)]
+
+        assert book_transactions.splits_for("asset:broker").all() == broker.subtree_splits().all()
+        assert len(book_transactions.splits_for("asset", recurse=False).all()) == 5
+        assert len(book_transactions.splits_for(asset, end=date(2015, 10, 21)).all()) == 1
+
+    def test_subtree_splits_sample(self, book_sample):
+        asset = book_sample.accounts(name="Asset")
+
+        assert [sp.value for sp in asset.subtree_splits(end=date(2014, 12, 15))] == [Decimal(500)]
+        assert sorted(sp.value for sp in book_sample.splits_for(asset, start=date(2014, 12, 15))) == \
+               [Decimal(-200), Decimal(-130), Decimal(150), Decimal(1000)]
+
+    def test_children_index(self, book_transactions, monkeypatch):
+        root = book_transactions.root_account
+        EUR = book_transactions.default_currency
+
+        # small lists are scanned
+        root.children(name="asset")
+        assert not root.children._indexes
+
+        monkeypatch.setattr(CallableList, "index_min_size", 0)
+        asset = root.children(name="asset")
+        exp = root.children(name="exp")
+        assert root.children(name="asset", type="ASSET") is asset
+        assert root.children._indexes[("name",)]["asset",] is asset
+
+        # the index is dropped when the collection changes
+        acc = Account(name="cash", type="ASSET", commodity=EUR, parent=root)
+        assert root.children(name="cash") is acc
+        acc.parent = asset
+        with pytest.raises(KeyError):
+            root.children(name="cash")
+        assert asset.children(name="cash") is acc
+
+        # or when an indexed attribute changes
+        acc.name = "wallet"
+        assert asset.children(name="wallet") is acc
+        with pytest.raises(KeyError):
+            asset.children(name="cash")
+
+        # but not when the attribute is set on objects that are not in the list
+        Account(name="other", type="ASSET", commodity=EUR, parent=asset)
+        asset.children(name="other")
+        Account(name="foo", type="ASSET", commodity=EUR, parent=root)
+        assert ("name",) in asset.children._indexes
+
+        # filters on non mapped attributes scan the list
+        assert asset.children(fullname="asset:wallet") is acc
+
+        # or when the values are reloaded (e.g. after a rollback)
+        book_transactions.save()
+        children = root.children
+        assert children(name="exp") is exp
+        exp.name = "zz"
+        assert children(name="zz") is exp
+        book_transactions.cancel()
+        assert children(name="exp") is exp
+        with pytest.raises(KeyError):
+            children(name="zz")
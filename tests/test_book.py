@@ -1,15 +1,21 @@
 import glob
 import os
 import pytest
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect
 from sqlalchemy.engine.reflection import Inspector
 from sqlalchemy.orm import Session
-from piecash import create_book, Account, GnucashException, Book, open_book, Commodity
+from piecash import create_book, Account, GnucashException, Book, open_book, Commodity, Transaction, \
+    GncValidationError, GncImbalanceError
 from piecash.core import Version
+from piecash.sa_extra import dispose_piecash_engines
 from test_helper import (db_sqlite_uri, db_sqlite, new_book, new_book_USD, book_uri,
-                         book_transactions, book_investment, book_sample, format_version)
+                         book_transactions, book_investment, book_sample, format_version, book_folder,
+                         capture_statements)
+from datetime import date, datetime
 from decimal import Decimal
 
+import pandas
+
 # dummy line to avoid removing unused symbols
 a = db_sqlite_uri, db_sqlite, new_book, new_book_USD, book_uri, book_transactions
 
@@ -214,6 +220,66 @@ class TestBook_open_book(object):
         with open_book(uri_conn=book_uri, open_if_lock=False) as b:
             pass
 
+    def test_open_reuse_engine(self, book_uri):
+        if not book_uri:
+            return
+        with create_book(uri_conn=book_uri):
+            pass
+
+        with open_book(uri_conn=book_uri, reuse_engine=True) as b:
+            engine = b.session.bind
+            assert b.default_currency.mnemonic == "EUR"
+
+        # the engine is reused and the versions are not checked again
+        with capture_statements(engine) as statements:
+            with open_book(uri_conn=book_uri, reuse_engine=True) as b:
+                assert b.session.bind is engine
+        assert not any("versions" in statement for statement in statements)
+
+        # but not with other options or without reuse_engine
+        with open_book(uri_conn=book_uri, reuse_engine=True, echo=False) as b:
+            assert b.session.bind is not engine
+        with open_book(uri_conn=book_uri) as b:
+            assert b.session.bind is not engine
+
+        # a new book on the same uri drops the engines of the uri
+        with create_book(uri_conn=book_uri, overwrite=True):
+            pass
+        with open_book(uri_conn=book_uri, reuse_engine=True) as b:
+            assert b.session.bind is not engine
+        dispose_piecash_engines(book_uri)
+
+    def test_open_sqlite_profile(self):
+        with create_book(db_sqlite, overwrite=True) as b:
+            Account(name="foo", type="ASSET", commodity=b.default_currency, parent=b.root_account)
+            b.save()
+
+        with open_book(db_sqlite, sqlite_profile="readonly-fast") as b:
+            assert b.accounts(name="foo").name == "foo"
+            assert b.session.execute("PRAGMA temp_store").scalar() == 2
+            assert b.session.execute("PRAGMA cache_size").scalar() == -65536
+            with pytest.raises(Exception):
+                b.session.execute("DELETE FROM accounts")
+
+        with pytest.raises(ValueError):
+            open_book(db_sqlite, sqlite_profile="readonly-fast", readonly=False)
+        with pytest.raises(ValueError):
+            open_book(db_sqlite, sqlite_profile="foo")
+
+        with open_book(db_sqlite, sqlite_profile="bulk-write", readonly=False, do_backup=False) as b:
+            Account(name="bar", type="ASSET", commodity=b.default_currency, parent=b.root_account)
+            b.flush()
+            assert b.session.execute("PRAGMA journal_mode").scalar() == "truncate"
+            # the commits are still synced to the file
+            assert b.session.execute("PRAGMA synchronous").scalar() == 2
+            b.save()
+
+        with open_book(db_sqlite) as b:
+            assert b.accounts(name="bar").name == "bar"
+
+        for fn in glob.glob("{}*".format(db_sqlite)):
+            os.remove(fn)
+
     def test_read_book_transactions(self, book_sample):
         assert len(book_sample.transactions) == 5
 
@@ -400,6 +466,399 @@ class TestBook_access_book(object):
 
         assert df_to_string == df.to_string()
 
+    def test_splits_df_matches_orm(self, book_transactions):
+        # fields mapped to columns, to gnc numerics, to the account fullname or only available through the ORM
+        fields = ["transaction.num", "account.type", "account.placeholder", "account.sign", "quantity"]
+        df = book_transactions.splits_df(additional_fields=fields)
+
+        assert len(df) == len(book_transactions.splits)
+        for sp in book_transactions.splits:
+            row = df.loc[sp.guid]
+            assert row["value"] == sp.value
+            assert row["account.fullname"] == sp.account.fullname
+            assert row["transaction.post_date"] == sp.transaction.post_date
+            assert list(row[-len(fields):]) == [sp.transaction.num, sp.account.type, sp.account.placeholder,
+                                                sp.account.sign, sp.quantity]
+
+    def test_iter_splits_df(self, book_transactions):
+        df = book_transactions.splits_df()
+
+        chunks = list(book_transactions.iter_splits_df(chunksize=5))
+        assert [len(chunk) for chunk in chunks] == [5, 5, 2]
+        assert list(pandas.concat(chunks).index) == list(df.index)
+
+        asset = book_transactions.accounts(name="asset")
+        df_asset = pandas.concat(book_transactions.iter_splits_df(start=date(2015, 10, 25),
+                                                                  end=date(2015, 10, 30),
+                                                                  account=asset))
+        assert list(df_asset["account.fullname"]) == ["asset", "asset", "asset:broker", "asset"]
+        assert list(df_asset["value"]) == [-100, -200, 185, -200]
+
+    def test_iter_splits_df_connection(self, book_transactions):
+        session = book_transactions.session
+
+        # queries can run on the session between chunks (the rows are streamed from a dedicated connection
+        # except with sqlite)
+        with capture_statements(session.bind) as statements:
+            signs = []
+            for df in book_transactions.iter_splits_df(chunksize=5, additional_fields=["account.sign"]):
+                signs.extend(df["account.sign"])
+                book_transactions.accounts(name="asset")
+        assert len(signs) == 12
+        i = [i for i, statement in enumerate(statements) if "FROM splits JOIN transactions" in statement][0]
+        assert (statements.connections[i] is session.connection()) == (session.bind.name == "sqlite")
+
+        # the changes not yet saved are seen
+        book_transactions.splits[0].memo = "not saved"
+        with capture_statements(session.bind) as statements:
+            memos = [memo for df in book_transactions.iter_splits_df(chunksize=5) for memo in df["memo"]]
+        assert "not saved" in memos
+        i = [i for i, statement in enumerate(statements) if "FROM splits JOIN transactions" in statement][0]
+        assert statements.connections[i] is session.connection()
+
+    def test_iter_prices_df(self, book_transactions):
+        chunks = list(book_transactions.iter_prices_df(chunksize=4))
+        assert [len(chunk) for chunk in chunks] == [4, 2]
+        assert list(chunks[0].columns) == list(book_transactions.prices_df().columns)
+
+        USD = book_transactions.currencies(mnemonic="USD")
+        df = pandas.concat(book_transactions.iter_prices_df(start=date(2015, 11, 1), currency=USD))
+        assert list(df["value"]) == [Decimal("1.23"), Decimal("1.27")]
+
+    def test_iter_splits_df_sample(self, book_sample):
+        assert len(pandas.concat(book_sample.iter_splits_df(start=date(2014, 12, 15), end=date(2014, 12, 31)))) == 9
+        assert len(pandas.concat(book_sample.iter_splits_df(end=date(2014, 12, 15)))) == 2
+
+    def test_iter_prices_df_iso_dates(self, book_transactions):
+        if book_transactions.session.bind.name != "sqlite":
+            pytest.skip("only sqlite stores the dates as text")
+
+        # store the dates of the prices in the format of GnuCash >= 2.7
+        book_transactions.session.execute("UPDATE prices SET date = substr(date, 1, 4) || '-' || substr(date, 5, 2) "
+                                          "|| '-' || substr(date, 7, 2) || ' ' || substr(date, 9, 2) || ':' "
+                                          "|| substr(date, 11, 2) || ':' || substr(date, 13, 2)")
+        USD = book_transactions.currencies(mnemonic="USD")
+        df = pandas.concat(book_transactions.iter_prices_df(start=date(2015, 11, 1), currency=USD))
+        assert list(df["value"]) == [Decimal("1.23"), Decimal("1.27")]
+        df = pandas.concat(book_transactions.iter_prices_df(end=date(2015, 10, 31), currency=USD))
+        assert len(df) == 1
+
+    def test_trial_balance(self, book_transactions):
+        EUR = book_transactions.default_currency
+
+        tb = book_transactions.trial_balance()
+        assert list(tb) == ["asset", "asset:broker", "exp", "foreign asset", "inc"]
+        assert tb["asset"] == Decimal("729.04")
+        assert tb["foreign asset"] == Decimal(0)
+        assert str(book_transactions.trial_balance(at_date=date(2015, 10, 20))["inc"]) == "0"
+
+        for at_date, currency in [(None, None), (date(2015, 10, 30), None), (date(2015, 10, 30), EUR)]:
+            tb = book_transactions.trial_balance(at_date=at_date, currency=currency)
+            for acc in book_transactions.accounts:
+                assert tb[acc.fullname] == acc.get_balance(at_date=at_date, recurse=True, commodity=currency)
+
+    def test_trial_balance_sample(self, book_sample):
+        tb = book_sample.trial_balance(at_date=date(2014, 12, 15))
+        assert tb["Asset"] == Decimal(500)
+        assert tb["Liability"] == Decimal(0)
+
+    def test_running_balance_df(self, book_transactions):
+        asset = book_transactions.accounts(name="asset")
+        exp = book_transactions.accounts(name="exp")
+
+        df = book_transactions.running_balance_df([asset, exp])
+        assert list(df["running_balance"]) == [1000, 900, 700, 500, 715, 20, 100, 115]
+
+        df = book_transactions.running_balance_df([asset], start=date(2015, 10, 26))
+        assert list(df["quantity"]) == [-200, -200, 215]
+        assert list(df["running_balance"]) == [700, 500, 715]
+
+        # with a datetime start, the splits posted earlier the same day are in the opening balance
+        start = datetime(2015, 10, 29, 12)
+        df = book_transactions.running_balance_df([asset], start=start)
+        assert list(df["quantity"]) == [-200, 215]
+        assert list(df["running_balance"]) == [500, 715]
+        df = book_transactions.balance_series([asset], start, datetime(2015, 10, 31, 12))
+        assert list(df["asset"]) == [700, 500, 715]
+
+    def test_balance_series(self, book_transactions):
+        asset = book_transactions.accounts(name="asset")
+        inc = book_transactions.accounts(name="inc")
+
+        df = book_transactions.balance_series([asset, inc], date(2015, 10, 20), date(2015, 11, 1))
+        assert list(df.columns) == ["asset", "inc"]
+        assert len(df) == 13
+        assert list(df["asset"]) == [0, 1000, 1000, 1000, 1000, 900, 900, 900, 900, 700, 500, 715, 715]
+        assert list(df["inc"]) == [0] + [1000] * 12
+        assert str(df["inc"].iloc[0]) == "0"
+
+        df = book_transactions.balance_series([asset], date(2015, 10, 22), date(2015, 11, 1), freq="W")
+        assert list(df["asset"]) == [900, 715]
+        for period_end, balance in df["asset"].items():
+            assert balance == asset.get_balance(at_date=period_end.date())
+
+    def test_balance_series_sample(self, book_sample):
+        asset = book_sample.accounts(name="Asset")
+
+        df = book_sample.running_balance_df([asset], start=date(2014, 12, 15))
+        # the splits posted the same day are sorted by num and enter_date
+        assert list(df["running_balance"]) == [1500, 1300, 1450, 1320]
+
+        df = book_sample.balance_series([asset], date(2014, 11, 15), date(2015, 1, 1), freq="SMS")
+        assert list(df["Asset"]) == [0, 500, 500, 1320]
+
+    def test_query_by_slot(self, book_transactions):
+        asset = book_transactions.accounts(name="asset")
+        broker = book_transactions.accounts(name="broker")
+        exp = book_transactions.accounts(name="exp")
+        asset["color"] = "red"
+        broker["color"] = "blue"
+        exp["a/b"] = Decimal("1.5")
+        broker["a/b"] = 3
+        exp["account"] = asset
+        tr = book_transactions.transactions(description="my purchase of stock")
+        tr.notes = "hello"
+        book_transactions.save()
+
+        assert book_transactions.query_by_slot(Account, "color", "red").all() == [asset]
+        assert set(book_transactions.query_by_slot(Account, "color")) == {asset, broker}
+        assert book_transactions.query_by_slot(Account, "color", "green").all() == []
+        assert book_transactions.query_by_slot(Account, "a/b", Decimal("1.50")).all() == [exp]
+        assert book_transactions.query_by_slot(Account, "a/b", 3).all() == [broker]
+        assert set(book_transactions.query_by_slot(Account, "a/b")) == {exp, broker}
+        assert book_transactions.query_by_slot(Account, "account", asset).all() == [exp]
+        assert book_transactions.query_by_slot(Transaction, "notes", "hello").all() == [tr]
+        assert book_transactions.query_by_slot(Transaction, "date-posted", tr.post_date.date()).all() == [tr]
+        with pytest.raises(ValueError):
+            book_transactions.query_by_slot(Account, "a", {"b": 3})
+
+        # same results with the index on slots
+        assert book_transactions.create_slots_index()
+        assert not book_transactions.create_slots_index()
+        book_transactions.save()
+        assert book_transactions.query_by_slot(Account, "a/b", 3).all() == [broker]
+
+    def test_bulk_insert_transactions(self, book_transactions):
+        asset = book_transactions.accounts(name="asset")
+        broker = book_transactions.accounts(name="broker")
+        n_tr = len(book_transactions.transactions)
+
+        guids = book_transactions.bulk_insert_transactions([
+            {"post_date": date(2015, 12, 1), "description": "bulk 1", "notes": "from the bank",
+             "splits": [{"account": asset, "value": Decimal("-12.5"), "memo": "out"},
+                        {"account": "exp", "value": Decimal("12.5")}]},
+            {"post_date": datetime(2015, 12, 2, 15, 30), "description": "bulk 2",
+             "splits": [{"account": asset, "value": -30},
+                        {"account": "asset:broker", "value": 30, "quantity": 2}]},
+        ])
+        assert not book_transactions.is_saved
+        book_transactions.save()
+        assert book_transactions.is_saved
+        assert len(book_transactions.transactions) == n_tr + 2
+
+        tr = book_transactions.transactions(guid=guids[0])
+        assert tr.description == "bulk 1"
+        assert tr.notes == "from the bank"
+        assert tr.post_date.date() == date(2015, 12, 1)
+        assert tr["date-posted"].value == date(2015, 12, 1)
+        assert sorted(sp.value for sp in tr.splits) == [Decimal("-12.5"), Decimal("12.5")]
+        assert tr.splits(memo="out").account == asset
+        assert book_transactions.transactions(guid=guids[1]).post_date.hour == 11
+        # the splits in another commodity get an action as with Split.validate
+        assert book_transactions.transactions(guid=guids[1]).splits(account=broker).action == "Buy"
+        assert book_transactions.transactions(guid=guids[1]).splits(account=asset).action == ""
+        assert asset.get_balance() == Decimal("672.5")
+        assert broker.get_balance() == Decimal(8)
+        assert len(broker.splits) == 2
+
+        # invalid batches are refused as a whole
+        exp = book_transactions.accounts(name="exp")
+        exp.placeholder = 1
+        book_transactions.flush()
+        for splits, exception in [([{"account": asset, "value": -1}, {"account": "inc", "value": 2}], GncImbalanceError),
+                                  ([{"account": asset, "value": -1}, {"account": exp, "value": 1}], GncValidationError),
+                                  ([{"account": asset, "value": -1}, {"account": "unknown", "value": 1}],
+                                   GncValidationError),
+                                  ([{"account": asset, "value": -1}, {"account": "inc", "value": 1, "quantity": 2}],
+                                   GncValidationError),
+                                  ]:
+            with pytest.raises(exception):
+                book_transactions.bulk_insert_transactions([
+                    {"splits": [{"account": asset, "value": -1}, {"account": "inc", "value": 1}]},
+                    {"splits": splits},
+                ])
+        assert len(book_transactions.transactions) == n_tr + 2
+
+    def test_bulk_transactions(self, book_transactions):
+        asset = book_transactions.accounts(name="asset")
+        inc = book_transactions.accounts(name="inc")
+        n_tr = len(book_transactions.transactions)
+
+        with book_transactions.bulk_transactions(batch_size=2) as bulk:
+            for i in range(5):
+                bulk.add({"post_date": date(2015, 12, 1 + i), "description": "salary {}".format(i),
+                          "splits": [{"account": asset, "value": 100}, {"account": inc, "value": -100}]})
+            assert len(bulk.guids) == 4
+        assert len(bulk.guids) == 5
+        assert len(book_transactions.transactions) == n_tr + 5
+        assert inc.get_balance() == Decimal(1500)
+
+        with pytest.raises(ValueError):
+            with book_transactions.bulk_transactions() as bulk:
+                bulk.add({"splits": [{"account": asset, "value": 100}, {"account": inc, "value": -100}]})
+                raise ValueError()
+        assert len(book_transactions.transactions) == n_tr + 5
+
+    def test_query_callable_list(self, book_transactions):
+        with capture_statements(book_transactions.session.bind) as statements:
+            transactions = book_transactions.transactions
+            assert statements == []
+            tr = transactions(description="my expense")
+            assert tr.description == "my expense"
+            assert len(statements) == 1 and "LIMIT" in statements[0]
+            assert transactions._loaded is False
+            with pytest.raises(KeyError):
+                transactions(description="foo")
+
+            # relationships and non column attributes
+            EUR = book_transactions.default_currency
+            assert book_transactions.accounts(name="asset", commodity=EUR).name == "asset"
+            assert book_transactions.accounts(fullname="asset:broker").name == "broker"
+            assert book_transactions.splits(memo="cost of X", value=Decimal(20)).value == Decimal(20)
+
+            # the filters are checked in python on the objects found by the database (sqlite converts 1 to '1'
+            # when comparing it to a text column, as mysql ignores the case of strings)
+            acc = book_transactions.accounts(name="asset")
+            acc.code = "1"
+            with pytest.raises(KeyError):
+                book_transactions.accounts(code=1)
+            assert book_transactions.accounts(code="1") is acc
+
+        # list semantics
+        transactions = book_transactions.transactions
+        assert len(transactions) == 5
+        assert transactions[0] in list(transactions)
+        assert transactions._loaded
+        assert transactions(description="my expense") is tr
+        assert sorted(book_transactions.currencies, key=lambda c: c.mnemonic)[0].mnemonic == "EUR"
+        assert book_transactions.currencies(mnemonic="CAD").mnemonic == "CAD"
+
+    def test_query_callable_list_dates(self, book_sample):
+        tr = book_sample.transactions(description="expense 1")
+
+        assert book_sample.transactions(enter_date=tr.enter_date) is tr
+        assert book_sample.transactions(post_date=tr.post_date, description="expense 1") is tr
+
+    def test_preload(self, book_transactions):
+        with capture_statements(book_transactions.session.bind) as statements:
+            accounts, splits = book_transactions.preload()
+            assert len(statements) == 3
+            assert len(splits) == 12
+            assert [sp.transaction.post_date for sp in splits] == sorted(sp.transaction.post_date for sp in splits)
+
+            # the preloaded relationships do not emit any query
+            statements.clear()
+            for acc in accounts:
+                acc.children, acc.commodity
+                for sp in acc.splits:
+                    sp.transaction.currency, sp.lot
+            assert statements == []
+
+            accounts, transactions, prices, commodities = book_transactions.preload("ledger")
+            assert len(statements) == 7
+            statements.clear()
+            for tr in transactions:
+                tr.notes, [sp.account.commodity for sp in tr.splits]
+            assert statements == []
+
+            with pytest.raises(ValueError):
+                book_transactions.preload("foo")
+
+    def test_open_book_preload(self):
+        with open_book(os.path.join(book_folder, "invoices.gnucash")) as book:
+            with capture_statements(book.session.bind) as statements:
+                book.preload("business")
+            # no query for the entries of the tax tables (as there is no tax table)
+            assert len(statements) == 7
+
+        with open_book(os.path.join(book_folder, "invoices.gnucash"), preload="business") as book:
+            customers, vendors, employees, billterms, taxtables, invoices = book._preloaded
+            assert len(invoices) > 0
+            assert all("entries" in inspect(invoice).dict for invoice in invoices)
+
+    def test_iter_transactions(self, book_sample):
+        session = book_sample.session
+
+        def transactions_in_session():
+            return [obj for obj in session.identity_map.values() if isinstance(obj, Transaction)]
+
+        transactions = []
+        for tr in book_sample.iter_transactions(batch_size=2):
+            # the previous batches have been removed from the session
+            assert len(transactions_in_session()) <= 2
+            assert "splits" in tr.__dict__
+            transactions.append((tr.post_date, tr.description, len(tr.splits)))
+
+        assert transactions == sorted(transactions, key=lambda x: x[0])
+        assert sorted((tr.post_date, tr.description, len(tr.splits))
+                      for tr in book_sample.transactions) == sorted(transactions)
+
+        # the transactions are kept in the session if there are changes
+        session.expunge_all()
+        for tr in book_sample.iter_transactions(batch_size=2):
+            tr.description = "foo"
+        assert len(transactions_in_session()) == len(transactions)
+
+    def test_iter_transactions_range(self, book_transactions):
+        transactions = list(book_transactions.iter_transactions(batch_size=2, start=date(2015, 10, 25),
+                                                                end=date(2015, 10, 30), with_splits=False))
+        assert [tr.description for tr in transactions] == ["my expense", "my purchase of stock",
+                                                           "transfer to foreign asset"]
+
+    def test_iter_transactions_range_sample(self, book_sample):
+        assert len(list(book_sample.iter_transactions(batch_size=2, start=date(2014, 12, 15),
+                                                      end=date(2014, 12, 31)))) == 4
+        assert [tr.description for tr in book_sample.iter_transactions(end=date(2014, 12, 15))] == ["Opening Balance"]
+
+    def test_iter_transactions_null_post_date(self, book_transactions):
+        # post_date is nullable in the schema of GnuCash
+        descriptions = ["my revenue", "my expense", "my purchase of stock"]
+        book_transactions.session.execute(Transaction.__table__.update()
+                                          .where(Transaction.description.in_(descriptions))
+                                          .values(post_date=None))
+        for batch_size in (1, 2, 3, 10):
+            transactions = list(book_transactions.iter_transactions(batch_size=batch_size, with_splits=False))
+            assert sorted(tr.description for tr in transactions[:3]) == sorted(descriptions)
+            assert [tr.description for tr in transactions[3:]] == ["transfer to foreign asset",
+                                                                   "transfer from foreign asset"]
+
+    def test_ensure_accounts(self, new_book):
+        type_map = {"Assets": "ASSET", "Assets:Receivables": "RECEIVABLE", "Expenses": "EXPENSE"}
+        accs = new_book.ensure_accounts(["Assets:Bank:Checking",
+                                         "Assets:Bank:Savings",
+                                         "Assets:Receivables:Foo",
+                                         "Expenses:Food"], type_map=type_map)
+        assert [acc.fullname for acc in accs] == ["Assets:Bank:Checking", "Assets:Bank:Savings",
+                                                  "Assets:Receivables:Foo", "Expenses:Food"]
+        assert [acc.type for acc in accs] == ["ASSET", "ASSET", "RECEIVABLE", "EXPENSE"]
+        assert all(acc.commodity == new_book.default_currency for acc in accs)
+        assert len(new_book.accounts) == 8
+
+        # existing accounts are reused
+        bank, checking = new_book.ensure_accounts(["Assets:Bank", "Assets:Bank:Checking"])
+        assert checking is accs[0]
+        assert bank is accs[0].parent
+        assert len(new_book.accounts) == 8
+
+        with pytest.raises(ValueError):
+            new_book.ensure_accounts(["Income:Salary"])
+        new_book.validate()
+
+        # many siblings under the same parent
+        new_book.ensure_accounts(["Expenses:Food:Item {}".format(i) for i in range(500)])
+        new_book.validate()
+        assert len(new_book.accounts(fullname="Expenses:Food").children) == 500
+
     def test_prices_df(self, book_transactions):
         df = book_transactions.prices_df().reset_index()
 
@@ -1,17 +1,18 @@
 # coding=utf-8
 from __future__ import unicode_literals
 
-from datetime import datetime
+from datetime import datetime, date
 from decimal import Decimal
 
 import pytest
 
 from piecash import Price, Commodity, GnucashException
 from piecash.core.commodity import GncPriceError
-from test_helper import db_sqlite_uri, db_sqlite, new_book, new_book_USD, book_uri, book_basic, is_not_on_web, is_inmemory_sqlite
+from test_helper import db_sqlite_uri, db_sqlite, new_book, new_book_USD, book_uri, book_basic, book_transactions, \
+    is_not_on_web, is_inmemory_sqlite
 
 # dummy line to avoid removing unused symbols
-a = db_sqlite_uri, db_sqlite, new_book, new_book_USD, book_uri, book_basic
+a = db_sqlite_uri, db_sqlite, new_book, new_book_USD, book_uri, book_basic, book_transactions
 
 
 class TestCommodity_create_commodity(object):
@@ -131,3 +132,29 @@ class TestCommodity_create_prices(object):
 
         with pytest.raises(GncPriceError):
             cdty.update_prices()
+
+    def test_price_at(self, book_transactions):
+        cdty = book_transactions.commodities(mnemonic="GnuCash Inc.")
+        USD = book_transactions.currencies(mnemonic="USD")
+        EUR = book_transactions.currencies(mnemonic="EUR")
+
+        assert cdty.price_at(date(2015, 11, 3), USD) == Decimal("1.23")
+        assert cdty.price_at(date(2015, 11, 1), USD) == Decimal("1.23")
+        assert cdty.price_at(date(2015, 11, 2), USD, method="next") == Decimal("1.27")
+        assert cdty.price_at(date(2015, 11, 3), USD, method="nearest") == Decimal("1.27")
+        assert cdty.price_at(None, USD) == Decimal("1.27")
+        assert cdty.price_at(date(2015, 10, 30), EUR) == Decimal("30.833333")
+        with pytest.raises(GncPriceError):
+            cdty.price_at(date(2015, 10, 30), USD)
+
+        # the index is refreshed when prices are flushed
+        p = Price(commodity=cdty, currency=USD, date=datetime(2015, 11, 3), value=Decimal("1.25"))
+        assert cdty.price_at(date(2015, 11, 3), USD) == Decimal("1.25")
+        book_transactions.delete(p)
+        assert cdty.price_at(date(2015, 11, 3), USD) == Decimal("1.23")
+        p = Price(commodity=cdty, currency=USD, date=datetime(2015, 10, 30), value=Decimal("1.20"))
+        assert cdty.price_at(date(2015, 10, 30), USD) == Decimal("1.20")
+        book_transactions.cancel()
+        with pytest.raises(GncPriceError):
+            cdty.price_at(date(2015, 10, 30), USD)
+
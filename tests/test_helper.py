@@ -1,8 +1,10 @@
 # -*- coding: latin-1 -*-
 import os
 import sys
+from contextlib import contextmanager
 from datetime import datetime
 import pytest
+from sqlalchemy import event
 from sqlalchemy_utils import database_exists, drop_database
 from piecash import create_book, open_book, Account, Commodity, Employee, Customer, Vendor, Transaction, Split, Price
 
@@ -266,7 +268,8 @@ def book_invoices(request):
 @pytest.yield_fixture(params=["", ".272"])
 def book_sample(request):
     """
-    Returns a simple sample book for 2.6.N
+    Returns a simple sample book for 2.6.N and for 2.7.2 (the dates are stored as YYYYMMDDHHMMSS before GnuCash 2.7
+    and as YYYY-MM-DD HH:MM:SS since)
     """
     file_template_full = os.path.join(book_folder, "simple_sample{}.gnucash".format(request.param))
 
@@ -274,6 +277,35 @@ def book_sample(request):
         yield book
 
 
+class Statements(list):
+    """The sql statements captured by :func:`capture_statements` (with the connection used by each statement
+    in connections)"""
+
+    def __init__(self):
+        list.__init__(self)
+        self.connections = []
+
+    def clear(self):
+        del self[:]
+        del self.connections[:]
+
+
+@contextmanager
+def capture_statements(engine):
+    """Capture the sql statements executed on the engine within the with block"""
+    statements = Statements()
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+        statements.connections.append(conn)
+
+    event.listen(engine, "before_cursor_execute", capture)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", capture)
+
+
 def is_inmemory_sqlite(book_basic):
     # print book_basic.uri, book_basic.uri.get_dialect(), book_basic.uri.database, type(book_basic.uri), dir(book_basic.uri)
     # print "sqlite" in book_basic.uri and ":memory:" in book_basic.uri
@@ -12,8 +12,10 @@ import pytest
 from piecash import create_book, Account, ACCOUNT_TYPES, open_book, Price
 from piecash._common import GnucashException
 from piecash.core.account import _is_parent_child_types_consistent, root_types
-from piecash.kvp import Slot
-from test_helper import file_template_full, file_for_test_full, run_file, file_ghost_kvp_scheduled_transaction, file_ghost_kvp_scheduled_transaction_for_test
+from piecash.kvp import Slot, SlotInt, SlotString, SlotDouble, SlotTime, SlotDate, SlotNumeric, SlotGUID, \
+    SlotFrame, SlotList, slot, slots_from_dict
+from test_helper import file_template_full, file_for_test_full, run_file, file_ghost_kvp_scheduled_transaction, file_ghost_kvp_scheduled_transaction_for_test, \
+    capture_statements
 
 
 @pytest.fixture
@@ -102,6 +104,38 @@ class TestIntegration_EmptyBook(object):
             else:
                 assert book[k].value == v
 
+    def test_slots_tree_load(self, book):
+        kv = {
+            "vint": 3,
+            "vstr": "hello",
+            "vdate": datetime.date(2018, 1, 2),
+            "vnum": Decimal('4.53'),
+            "vlist": ["stri", 4, dict(foo=23, account=book.root_account)],
+            "vfr": {"vfr2": {"foo": 33, "baz": "hello"}, "coo": Decimal('4.53')},
+        }
+        book["options"] = kv
+        book.save()
+        book.session.expire_all()
+
+        options = book["options"]
+        with capture_statements(book.session.bind) as statements:
+            # the whole tree in one query (the account of the GUID slot is found in the identity map)
+            assert options.value == kv
+            assert len(statements) == 1
+            assert "slots" in options.__dict__
+
+            # the slots collections are populated: no more query
+            assert options.value == kv
+            assert book["options/vlist"].value == kv["vlist"]
+            assert len(statements) == 1
+
+        # the tree is also loaded with pending changes in the session (flushed as by a lazy load)
+        book.session.expire_all()
+        book["other"] = 1
+        options = book["options"]
+        assert options.value == kv
+        assert "slots" in options.__dict__
+
     def test_slots_strings_access(self, book):
         b = book
         del b["default-currency"]
@@ -160,6 +194,112 @@ class TestIntegration_EmptyBook(object):
         book.session.flush()
         assert {n for (n,) in book.session.query(Slot._name)} == set([])
 
+    def test_slots_name_index(self, book):
+        b = book
+        b["a/b"] = 1
+        assert "a" in b and "b" in b["a"]
+
+        # the index follows the changes made directly on the slots collections
+        b.slots.append(SlotInt(name="c", value=2))
+        b["a"].slots.append(SlotString(name="a/s", value="x"))
+        assert b["c"].value == 2
+        assert b["a/s"].value == "x"
+
+        b.slots.remove(b["c"])
+        del b["a"].slots[:]
+        assert "c" not in b
+        assert "b" not in b["a"]
+        with pytest.raises(KeyError):
+            b["a/s"]
+
+        b["a/b"] = 3
+        b["l"] = [1, 2]
+        b["l"].slots.append(SlotInt(name="l/2", value=3))
+        assert b["l/2"].value == 3
+        assert b["l"].value == [1, 2, 3]
+        b.flush()
+        assert b["a/b"].value == 3
+
+        # the first slot is returned in case of duplicate names
+        first = b["a/b"]
+        b["a"].slots.append(SlotInt(name="a/b", value=4))
+        assert b["a/b"] is first
+        del b["a/b"]
+        assert b["a/b"].value == 4
+
+    def test_slot_dispatch(self, book):
+        now = datetime.datetime.now()
+        for value, cls in [(1, SlotInt), (True, SlotInt), ("a", SlotString), (2.3, SlotDouble),
+                           (now, SlotTime), (now.date(), SlotDate), (Decimal("1.2"), SlotNumeric),
+                           ((1, 2), SlotNumeric), (book.root_account, SlotGUID),
+                           ({"a": 1}, SlotFrame), ([1], SlotList)]:
+            assert type(slot(book, "account", value)) is cls
+
+        with pytest.raises(ValueError):
+            slot(book, "weird", lambda x: x)
+
+        slots = slots_from_dict(book, {"a": {"b": [1, {"c": "d"}]}, "e": 2})
+        book.slots.extend(slots)
+        assert book["a/b"].value == [1, {"c": "d"}]
+        assert book["a/b/1/c"].value == "d"
+        assert book["e"].value == 2
+
+    def test_preload_slots(self, book):
+        EUR = book.default_currency
+        for i in range(3):
+            acc = Account(name="acc{}".format(i), type="ASSET", commodity=EUR, parent=book.root_account)
+            acc["color"] = "red"
+            acc["a/b/c"] = i
+            acc["l"] = [1, {"x": "y"}]
+        book["account"] = book.root_account
+        book.save()
+        book.session.expire_all()
+
+        with capture_statements(book.session.bind) as statements:
+            accounts = book.preload_slots(book.session.query(Account).filter(Account.type == "ASSET"))
+            n_statements = len(statements)
+            # accounts + one query per level of nesting (slots of the accounts, of a and l, of a/b and l/1)
+            assert n_statements == 4
+            assert sorted(acc["a/b/c"].value for acc in accounts) == [0, 1, 2]
+            assert all(acc["color"].value == "red" for acc in accounts)
+            assert all(acc["l"].value == [1, {"x": "y"}] for acc in accounts)
+            assert all(acc["a/b"].parent is acc["a"] for acc in accounts)
+            assert len(statements) == n_statements
+
+        # GUID slots are not followed and the book can be preloaded too
+        book.preload_slots([book])
+        assert book["account"].value == book.root_account
+
+    def test_resolve_guid_slots(self, book):
+        EUR = book.default_currency
+        accounts = [Account(name="acc{}".format(i), type="ASSET", commodity=EUR, parent=book.root_account)
+                    for i in range(3)]
+        book.flush()
+        for acc, peer in zip(accounts, accounts[1:] + accounts[:1]):
+            acc["account"] = peer
+        accounts[0]["CURRENCY::EUR"] = book.root_account
+        book.save()
+        book.session.expunge_all()
+
+        with capture_statements(book.session.bind) as statements:
+            accounts = book.preload_slots(book.session.query(Account).filter(Account.type == "ASSET"),
+                                          resolve_guids=True)
+            n_statements = len(statements)
+            # accounts + their slots + the accounts referred to that are not yet loaded (the root account)
+            assert n_statements == 3
+            names = {acc["account"].value.name for acc in accounts}
+            assert names == {"acc0", "acc1", "acc2"}
+            root = [acc for acc in accounts if acc.name == "acc0"][0]["CURRENCY::EUR"].value
+            assert root.type == "ROOT"
+            assert len(statements) == n_statements
+
+        # the cached object follows the changes of the slot
+        acc = accounts[0]
+        acc["account"] = acc
+        assert acc["account"].value is acc
+        acc["account"].guid_val = root.guid
+        assert acc["account"].value is root
+
     def test_smart_slots(self, book):
         del book["default-currency"]
         book["account"] = book.root_account
@@ -7,7 +7,8 @@ from decimal import Decimal
 
 import pytest
 
-from piecash import Transaction, Split, GncImbalanceError, GncValidationError, Lot
+from piecash import Transaction, Split, GncImbalanceError, GncValidationError, Lot, Price
+from piecash._common import sum_gncnumeric
 from test_helper import db_sqlite_uri, db_sqlite, new_book, new_book_USD, book_uri, book_basic, book_transactions
 
 # dummy line to avoid removing unused symbols
@@ -286,3 +287,50 @@ class TestTransaction_changes(object):
         tr.post_date = datetime(2015, 1, 29, tzinfo=tr.post_date.tzinfo)
         book_transactions.validate()
         assert len(book_transactions.prices) == 7
+
+    def test_cdty_split_price_upsert(self, book_transactions):
+        broker = book_transactions.accounts(name="broker")
+        asset = book_transactions.accounts(name="asset")
+        EUR = book_transactions.default_currency
+
+        def stock_prices():
+            return [p for p in book_transactions.prices
+                    if p.type == "transaction" and p.commodity == broker.commodity]
+
+        # two purchases on the same (new) date share the same price
+        for qty in (2, 4):
+            Transaction(currency=EUR, description="buy", post_date=datetime(2015, 12, 1),
+                        splits=[Split(account=asset, value=-10),
+                                Split(account=broker, value=10, quantity=qty)])
+            book_transactions.validate()
+        assert len(stock_prices()) == 2
+
+        # a deleted price is not reused
+        p = [p for p in stock_prices() if p.date.month == 12][0]
+        book_transactions.delete(p)
+        book_transactions.flush()
+        assert len(stock_prices()) == 1
+        Transaction(currency=EUR, description="buy", post_date=datetime(2015, 12, 1),
+                    splits=[Split(account=asset, value=-10),
+                            Split(account=broker, value=10, quantity=5)])
+        book_transactions.validate()
+        assert len(stock_prices()) == 2
+
+
+class TestTransaction_sums(object):
+    def test_sum_gncnumeric(self, book_transactions):
+        session = book_transactions.session
+
+        # all transactions are balanced
+        sums = sum_gncnumeric(session, Split._value_num, Split._value_denom, group_by=[Split.transaction_guid])
+        assert len(sums) == len(book_transactions.transactions)
+        assert all(v == 0 for v in sums.values())
+
+        # exact sum of the quantities of an account
+        broker = book_transactions.accounts(name="broker")
+        assert sum_gncnumeric(session, Split._quantity_num, Split._quantity_denom,
+                              where=[Split.account_guid == broker.guid]) == Decimal(6)
+
+        # exact sum of the prices (some have 6 decimals)
+        assert sum_gncnumeric(session, Price._value_num, Price._value_denom) == sum(p.value
+                                                                                  for p in book_transactions.prices)